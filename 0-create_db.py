@@ -1,10 +1,12 @@
 #!/usr/bin/python3
 
+import projectconf as cf
 import server
 
 if __name__ == '__main__':
-    db = server.DataBase()
-    db.create_tables()
-    db.create_items()
-    db.close()
-
+    # The items catalog is replicated to every shard
+    for name in server.shard_names(cf.base_name, cf.shards):
+        db = server.DataBase(name)
+        db.migrate()
+        db.create_items()
+        db.close()
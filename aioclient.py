@@ -0,0 +1,302 @@
+""" Asynchronous client library for GameServer, for bots, services and tools """
+
+import asyncio
+import collections
+import projectconf as cf
+
+
+class _Connection:
+    """
+    One connection to the server. Requests are written as soon as they are made (pipelining),
+    answers come in the order of requests and are matched to the waiting callers
+    """
+
+    def __init__(self, host: str, port: int, timeout: float, on_event=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.on_event = on_event  # Called with event messages of the server: on_event({'event': name, ...})
+        self.codec = cf.default_codec
+        self.player = {}
+        self._reader = None
+        self._writer = None
+        self._pending = collections.deque()  # Futures (queues for streams) of the sent requests, oldest first
+        self._receiver = None
+        self.closed = True
+
+    @property
+    def load(self) -> int:
+        return len(self._pending)
+
+    async def open(self, nickname: str) -> dict:
+        """ Connect and log in, returns the player """
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        self.closed = False
+        self._receiver = asyncio.ensure_future(self._receive())
+        self.player = await self.call({'login': nickname, 'codecs': cf.preferred_codecs})
+        if not self.player.get('id'):
+            await self.close()
+            return self.player
+        self.codec = cf.choose_codec([self.player.get('codec', cf.default_codec.name)])
+        return self.player
+
+    def _encode(self, request: dict) -> bytes:
+        """ Frame of the request, with the session token once logged in """
+        if 'token' in self.player:
+            request = dict(request, token=self.player['token'])
+        return cf.encode(request, self.codec)
+
+    async def call(self, request: dict) -> dict:
+        if self.closed:
+            raise ConnectionError('Connection is closed')
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append(future)
+        self._writer.write(self._encode(request))
+        await self._writer.drain()
+        # On timeout the future is cancelled but stays in the queue, so later answers still match their requests
+        return await asyncio.wait_for(future, self.timeout)
+
+    async def stream(self, request: dict):
+        """ Send a request with a streamed answer, yields its parts as they arrive """
+        if self.closed:
+            raise ConnectionError('Connection is closed')
+        parts = asyncio.Queue()
+        self._pending.append(parts)
+        self._writer.write(self._encode(request))
+        await self._writer.drain()
+        while True:
+            part = await asyncio.wait_for(parts.get(), self.timeout)
+            if isinstance(part, Exception):
+                raise part
+            yield part
+            if not part.get('more'):
+                return
+
+    async def _receive(self):
+        error = ConnectionError('Connection closed by server')
+        try:
+            while True:
+                header = await self._reader.readexactly(cf.header_size)
+                answer = cf.decode(await self._reader.readexactly(cf.payload_size(header)), self.codec)
+                if isinstance(answer, dict) and 'event' in answer:
+                    if answer['event'] == 'shutdown':
+                        self.closed = True  # Sent requests are still answered, new ones go to another connection
+                    if self.on_event:
+                        self.on_event(answer)
+                    continue
+                if isinstance(self._pending[0], asyncio.Queue):
+                    self._pending[0].put_nowait(answer)
+                    if isinstance(answer, dict) and answer.get('more'):
+                        continue  # More parts of the same answer follow
+                    self._pending.popleft()
+                    continue
+                future = self._pending.popleft()
+                if not future.done():
+                    future.set_result(answer)
+        except (asyncio.IncompleteReadError, OSError, ValueError, IndexError) as e:
+            if not isinstance(e, asyncio.IncompleteReadError):
+                error = ConnectionError('Connection broken: {!r}'.format(e))
+        finally:
+            self.closed = True
+            while self._pending:
+                future = self._pending.popleft()
+                if isinstance(future, asyncio.Queue):
+                    future.put_nowait(error)
+                elif not future.done():
+                    future.set_exception(error)
+
+    async def close(self):
+        if self._writer is None:
+            return
+        if not self.closed:
+            self.closed = True
+            self._writer.write(cf.encode({'logout': self.player.get('nickname', '')}, self.codec))
+            try:
+                await self._writer.drain()
+            except OSError:
+                pass
+        self._writer.close()
+        if self._receiver:
+            self._receiver.cancel()
+
+
+class PlayerMirror:
+    """ Local copy of the player's credits and inventory, kept current by the events of a subscription """
+
+    def __init__(self, state: dict):
+        self.credits = state.get('credits')
+        self.items = {item_id: quantity for item_id, quantity in state.get('items', [])}  # Item id -> quantity
+
+    def apply(self, event: dict):
+        if event.get('event') == 'credits':
+            self.credits = event['credits']
+        elif event.get('event') == 'item':
+            if event['quantity']:
+                self.items[event['item_id']] = event['quantity']
+            else:
+                self.items.pop(event['item_id'], None)
+
+
+class AsyncGameClient:
+    """
+    Asynchronous client backed by a pool of pipelined connections.
+    Every connection logs in as the same player. A request goes to the least loaded connection,
+    broken connections are re-opened on the next request, reads are retried on connection errors.
+    Requests made concurrently may be served by different connections, so await one request
+    before making another when their order matters.
+    on_event(event) is called with event messages of the server, e.g. {'event': 'shutdown'} (once per connection).
+    After subscribe() the server pushes the player's changes, and mirror has the current credits and inventory
+    without asking the server; writes are sent over the subscribed connection then, so the mirror includes
+    a write once it is answered. If that connection closes, the next request subscribes again.
+    usage:
+        api = AsyncGameClient()
+        player = await api.login('nickname')
+        items = await api.get_items()
+        await api.buy(items[0]['id'])
+        await api.close()
+    """
+
+    def __init__(self, host: str = cf.host, port: int = cf.port, pool_size: int = cf.client_pool_size,
+                 timeout: float = cf.client_timeout, retries: int = cf.client_retries, on_event=None):
+        self.host = host
+        self.port = port
+        self.on_event = on_event
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.nickname = ''
+        self.player = {}
+        self._pool = []
+        self._mirror = None
+        self._subscription = None   # Connection receiving the events of the mirror
+
+    @property
+    def player_id(self):
+        return self.player.get('id')
+
+    @property
+    def mirror(self):
+        """ PlayerMirror of subscribe() while its connection is open, else None """
+        if self._subscription is None or self._subscription.closed:
+            return None
+        return self._mirror
+
+    def _on_event(self, event: dict):
+        if self._mirror is not None:
+            self._mirror.apply(event)  # Events sent before the answer to subscribe are already in its state
+        if self.on_event:
+            self.on_event(event)
+
+    async def login(self, nickname: str) -> dict:
+        """ Log in and open the pool, returns the player or {'status': 'failed'} """
+        await self.close()
+        conn = _Connection(self.host, self.port, self.timeout, self._on_event)
+        player = await conn.open(nickname)
+        if not player.get('id'):
+            return player
+        self.nickname = nickname
+        self.player = player
+        self._pool = [conn]
+        others = [_Connection(self.host, self.port, self.timeout, self._on_event) for _ in range(self.pool_size - 1)]
+        await asyncio.gather(*(c.open(nickname) for c in others))
+        self._pool.extend(others)
+        return player
+
+    async def close(self):
+        """ Log out every connection """
+        pool, self._pool = self._pool, []
+        self._mirror = self._subscription = None
+        await asyncio.gather(*(c.close() for c in pool))
+
+    async def _connection(self, request: dict = None) -> _Connection:
+        if not self._pool:
+            raise ConnectionError('Not logged in')
+        if self._mirror is not None and self.mirror is None:
+            # The subscribed connection was closed, e.g. reaped as idle: subscribe again to keep the mirror current
+            self._mirror = None
+            await self.subscribe()
+        if request is not None and 'get' not in request and self.mirror is not None:
+            return self._subscription  # Events of the write come before its answer
+        conn = min(self._pool, key=lambda c: (c.closed, c.load))
+        if conn.closed:
+            conn = _Connection(self.host, self.port, self.timeout, self._on_event)
+            await conn.open(self.nickname)
+            self._pool = [c for c in self._pool if not c.closed] + [conn]
+        return conn
+
+    async def call(self, request: dict) -> dict:
+        """ Send any request for the logged-in player (the connection's session token is added); returns the answer """
+        attempts = self.retries + 1 if 'get' in request else 1  # Only reads are safe to repeat
+        for attempt in range(attempts):
+            try:
+                return await (await self._connection(request)).call(request)
+            except ConnectionError:
+                if attempt + 1 == attempts:
+                    raise
+                await asyncio.sleep(cf.client_retry_delay)
+
+    async def batch(self, *requests: dict) -> list:
+        """ Several commands in one round trip, returns their answers """
+        answer = await self.call({'batch': list(requests)})
+        return answer.get('batch', [])
+
+    async def stream(self, request: dict):
+        """ Send a listing request in streaming mode, yields the parts of the answer as they arrive """
+        conn = await self._connection()
+        async for part in conn.stream(dict(request, stream=True)):
+            yield part
+
+    async def subscribe(self):
+        """ Start the server push of the player's changes, returns the PlayerMirror or None if refused """
+        conn = self._subscription if self.mirror is not None else await self._connection()
+        self._mirror = None
+        answer = await conn.call({'subscribe': True})
+        if answer.get('status') != 'success':
+            return None
+        self._subscription = conn
+        self._mirror = PlayerMirror(answer)
+        return self._mirror
+
+    async def get_items(self) -> list:
+        return (await self.call({'get': 'items'})).get('items', [])
+
+    async def get_items_page(self, after_id: int = 0, limit: int = cf.page_size) -> tuple:
+        """ One page of the items which can be bought: (items, after_id of the next page or None) """
+        answer = await self.call({'get': 'items', 'after_id': after_id, 'limit': limit})
+        return answer.get('items', []), answer.get('next')
+
+    async def iter_items(self):
+        """ Yields the items which can be bought, streamed in parts, for large catalogs """
+        async for part in self.stream({'get': 'items'}):
+            for item in part.get('items', []):
+                yield item
+
+    async def get_inventory(self) -> dict:
+        """ {'items': [...], 'credits': credits} """
+        return await self.call({'get': 'inventory'})
+
+    async def get_inventory_page(self, after_id: int = 0, limit: int = cf.page_size) -> tuple:
+        """ One page of the owned items: (items, after_id of the next page or None) """
+        answer = await self.call({'get': 'inventory', 'after_id': after_id, 'limit': limit})
+        return answer.get('items', []), answer.get('next')
+
+    async def get_credits(self) -> int:
+        return (await self.call({'get': 'credits'}))['credits']
+
+    async def buy(self, item_id: int) -> bool:
+        return (await self.call({'buy': item_id})).get('status') == 'success'
+
+    async def sell(self, item_id: int) -> bool:
+        return (await self.call({'sell': item_id})).get('status') == 'success'
+
+    async def game(self, bet: int) -> bool:
+        """ True if the bet won """
+        return (await self.call({'game': bet})).get('status') == 'success'
+
+    async def get_leaderboard(self, limit: int = 10) -> dict:
+        """ {'players': the richest, 'items': the most owned, 'rank': place of the player, 'total': players} """
+        return await self.call({'get': 'leaderboard', 'limit': limit})
+
+    async def stats(self) -> dict:
+        return await self.call({'get': 'stats'})
@@ -0,0 +1,145 @@
+""" Compact binary serialization: pure python implementation of the MessagePack format subset
+    (nil, bool, int, float, str, bin, array, map). Wire compatible with the msgpack package. """
+
+import struct
+
+_b = struct.Struct('>B').pack
+_h = struct.Struct('>H').pack
+_i = struct.Struct('>I').pack
+_int = {                            # Tag byte -> struct of the fixed size number after it
+    0xcc: struct.Struct('>B'), 0xcd: struct.Struct('>H'), 0xce: struct.Struct('>I'), 0xcf: struct.Struct('>Q'),
+    0xd0: struct.Struct('>b'), 0xd1: struct.Struct('>h'), 0xd2: struct.Struct('>i'), 0xd3: struct.Struct('>q'),
+    0xca: struct.Struct('>f'), 0xcb: struct.Struct('>d'),
+}
+
+
+def _pack_int(n: int, out: list):
+    if 0 <= n < 0x80:
+        out.append(_b(n))
+    elif -0x20 <= n < 0:
+        out.append(_b(n & 0xff))
+    elif n >= 0:
+        for tag, limit in ((0xcc, 0x100), (0xcd, 0x10000), (0xce, 0x100000000), (0xcf, 0x10000000000000000)):
+            if n < limit:
+                out.append(_b(tag) + _int[tag].pack(n))
+                return
+        raise OverflowError('Integer too big: {}'.format(n))
+    else:
+        for tag, limit in ((0xd0, 0x80), (0xd1, 0x8000), (0xd2, 0x80000000), (0xd3, 0x8000000000000000)):
+            if n >= -limit:
+                out.append(_b(tag) + _int[tag].pack(n))
+                return
+        raise OverflowError('Integer too small: {}'.format(n))
+
+
+def _pack_len(n: int, fix: int, fix_limit: int, tags: tuple, out: list):
+    """ Header of a sized object: fix form when possible, else 8 (str/bin only), 16 or 32 bit length """
+    if fix is not None and n < fix_limit:
+        out.append(_b(fix | n))
+    elif tags[0] is not None and n < 0x100:
+        out.append(_b(tags[0]) + _b(n))
+    elif n < 0x10000:
+        out.append(_b(tags[1]) + _h(n))
+    else:
+        out.append(_b(tags[2]) + _i(n))
+
+
+def _pack(obj, out: list):
+    if obj is None:
+        out.append(b'\xc0')
+    elif obj is True:
+        out.append(b'\xc3')
+    elif obj is False:
+        out.append(b'\xc2')
+    elif isinstance(obj, int):
+        _pack_int(obj, out)
+    elif isinstance(obj, float):
+        out.append(b'\xcb' + _int[0xcb].pack(obj))
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        _pack_len(len(data), 0xa0, 32, (0xd9, 0xda, 0xdb), out)
+        out.append(data)
+    elif isinstance(obj, (bytes, bytearray)):
+        _pack_len(len(obj), None, 0, (0xc4, 0xc5, 0xc6), out)
+        out.append(bytes(obj))
+    elif isinstance(obj, (list, tuple)):
+        _pack_len(len(obj), 0x90, 16, (None, 0xdc, 0xdd), out)
+        for value in obj:
+            _pack(value, out)
+    elif isinstance(obj, dict):
+        _pack_len(len(obj), 0x80, 16, (None, 0xde, 0xdf), out)
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError('Can not serialize {}'.format(type(obj)))
+
+
+def packb(obj) -> bytes:
+    out = []
+    _pack(obj, out)
+    return b''.join(out)
+
+
+def _unpack(b: bytes, pos: int):
+    """ Returns (object, position after it) """
+    tag = b[pos]
+    pos += 1
+    if tag < 0x80:
+        return tag, pos
+    if tag >= 0xe0:
+        return tag - 0x100, pos
+    if 0xa0 <= tag < 0xc0:
+        end = pos + (tag & 0x1f)
+        return b[pos:end].decode('utf-8'), end
+    if 0x90 <= tag < 0xa0:
+        return _unpack_array(b, pos, tag & 0x0f)
+    if 0x80 <= tag < 0x90:
+        return _unpack_map(b, pos, tag & 0x0f)
+    if tag == 0xc0:
+        return None, pos
+    if tag == 0xc2:
+        return False, pos
+    if tag == 0xc3:
+        return True, pos
+    if tag in _int:
+        s = _int[tag]
+        return s.unpack_from(b, pos)[0], pos + s.size
+    if tag in (0xd9, 0xda, 0xdb, 0xc4, 0xc5, 0xc6):
+        s = _int[{0xd9: 0xcc, 0xda: 0xcd, 0xdb: 0xce, 0xc4: 0xcc, 0xc5: 0xcd, 0xc6: 0xce}[tag]]
+        n = s.unpack_from(b, pos)[0]
+        pos += s.size
+        data = b[pos:pos + n]
+        return (data.decode('utf-8') if tag >= 0xd9 else bytes(data)), pos + n
+    if tag in (0xdc, 0xdd, 0xde, 0xdf):
+        s = _int[0xcd if tag in (0xdc, 0xde) else 0xce]
+        n = s.unpack_from(b, pos)[0]
+        pos += s.size
+        return (_unpack_array if tag in (0xdc, 0xdd) else _unpack_map)(b, pos, n)
+    raise ValueError('Unsupported type tag 0x{:02x}'.format(tag))
+
+
+def _unpack_array(b: bytes, pos: int, n: int):
+    result = []
+    for _ in range(n):
+        value, pos = _unpack(b, pos)
+        result.append(value)
+    return result, pos
+
+
+def _unpack_map(b: bytes, pos: int, n: int):
+    result = {}
+    for _ in range(n):
+        key, pos = _unpack(b, pos)
+        result[key], pos = _unpack(b, pos)
+    return result, pos
+
+
+def unpackb(b: bytes):
+    try:
+        obj, pos = _unpack(b, 0)
+    except (IndexError, struct.error, UnicodeDecodeError) as e:
+        raise ValueError('Malformed data: {}'.format(e))
+    if pos != len(b):
+        raise ValueError('Extra data after object')
+    return obj
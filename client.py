@@ -1,8 +1,9 @@
 #!/srv/anaconda3/bin/python3.7
 
-import socket
+import asyncio
 import logging
 import projectconf as cf
+from aioclient import AsyncGameClient
 
 logging.disable(logging.CRITICAL)
 # logging.basicConfig(level=logging.DEBUG)
@@ -10,15 +11,17 @@ logging.disable(logging.CRITICAL)
 
 class GameClient:
     """
-    Class for working with a remote GameServer.
+    Interactive front end for a remote GameServer, the protocol is handled by AsyncGameClient.
     Usage:
-        s = server.GameClient()
+        s = client.GameClient()
         s.start()
     """
     def __init__(self, host: str = cf.host, port: int = cf.port):
         self.host = host
         self.port = port
-        self._socket = None
+        self._api = AsyncGameClient(host, port, pool_size=1, on_event=self._on_event)
+        self._loop = asyncio.new_event_loop()
+        self._server_stopping = False
         self.player_name = ''
         self.player_id = ''
         self.ui = ({'label': 'Inventory',   'def': self._show_inventory},
@@ -29,23 +32,34 @@ class GameClient:
     def start(self):
         print('Welcome to %GAME%')
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as self._socket:
-                self._socket.connect((self.host, self.port))
-
-                try:
-                    self._login()
-                    self._show_mainscreen()
-                    print('Close connection')
+            try:
+                self._login()
+                self._show_mainscreen()
+                print('Close connection')
 
-                except KeyboardInterrupt:
-                    print('KeyboardInterrupt. Exit')
-                    if self.player_id:
-                        self._logout()
+            except KeyboardInterrupt:
+                print('KeyboardInterrupt. Exit')
+                if self.player_id:
+                    self._logout()
 
         except ConnectionRefusedError:
             print("Server is not available. Try later or contact support")
-        except BrokenPipeError:
-            print("Broken pipe. Contact support")
+        except (ConnectionError, asyncio.TimeoutError):
+            if self._server_stopping:
+                print("Server stopped. Try later")
+            else:
+                print("Connection lost. Contact support")
+        finally:
+            self._loop.close()
+
+    def _on_event(self, event: dict):
+        if event.get('event') == 'shutdown':
+            self._server_stopping = True
+            print('Server is shutting down')
+
+    def _run(self, coro):
+        """ Wait for a call of the async API """
+        return self._loop.run_until_complete(coro)
 
     def _show_mainscreen(self):
         mainscreen_msg = 'Choose from the following options:\n'
@@ -64,18 +78,15 @@ class GameClient:
                 pass
 
     def _show_inventory(self):
-        g = {'get': 'inventory', 'player_id': self.player_id}
-        self._socket.sendall(cf.encode(g))
-
-        response = cf.decode(self._socket.recv(cf._max_buffer))
+        response = self._run(self._api.get_inventory())
         items = response['items']
         credits_ = response['credits']
 
         print('Inventory:')
         print('Credits: {}'.format(credits_))
-        print('id  {:<25}{}'.format('name', 'price'))
+        print('id  {:<25}{:<8}{}'.format('name', 'price', 'quantity'))
         for idx, item in enumerate(items, 1):
-            print('{:>2}. {:<25}{}'.format(idx, item['name'], item['price']))
+            print('{:>2}. {:<25}{:<8}{}'.format(idx, item['name'], item['price'], item['quantity']))
         print(' 0. Exit')
 
         while True:
@@ -83,11 +94,7 @@ class GameClient:
                 n = int(input('Sell item: '))
                 if not n:
                     break
-                g = {'sell': items[n-1]['id'], 'player_id': self.player_id}
-                self._socket.sendall(cf.encode(g))
-
-                response = cf.decode(self._socket.recv(cf._max_buffer))
-                if response['status'] == 'success':
+                if self._run(self._api.sell(items[n-1]['id'])):
                     print('Congratulations! You sold {}'.format(items[n-1]['name']))
                 else:
                     print("Something went wrong")
@@ -99,17 +106,14 @@ class GameClient:
                 continue
 
     def _show_shop(self):
-        g = {'get': 'items', 'player_id': self.player_id}
-        self._socket.sendall(cf.encode(g))
-
-        response = cf.decode(self._socket.recv(cf._max_buffer))
-        items = response['items']
-
-        g = {'get': 'credits', 'player_id': self.player_id}
-        self._socket.sendall(cf.encode(g))
-
-        response = cf.decode(self._socket.recv(cf._max_buffer))
-        cr = response['credits']
+        if self._api.mirror:
+            items = self._run(self._api.get_items())
+            cr = self._api.mirror.credits
+        else:
+            # The items and the balance in one round trip
+            items_response, credits_response = self._run(self._api.batch({'get': 'items'}, {'get': 'credits'}))
+            items = items_response.get('items', [])
+            cr = credits_response['credits']
 
         print('Shop:')
         print('Your credits: {}'.format(cr))
@@ -124,11 +128,7 @@ class GameClient:
                 n = int(input('Buy item: '))
                 if not n:
                     break
-                g = {'buy': items[n-1]['id'], 'player_id': self.player_id}
-                self._socket.sendall(cf.encode(g))
-
-                response = cf.decode(self._socket.recv(cf._max_buffer))
-                if response['status'] == 'success':
+                if self._run(self._api.buy(items[n-1]['id'])):
                     print('Congratulations! You bought {}'.format(items[n-1]['name']))
                 else:
                     print("Something went wrong")
@@ -140,15 +140,13 @@ class GameClient:
                 continue
 
     def _logout(self):
-        self._socket.sendall(cf.encode({'logout': '1'}))
+        self._run(self._api.close())
         return 'exit'
 
     def _login(self):
         while True:
             login = input('Your login: ')
-            self._socket.sendall(cf.encode({'login': login}))
-
-            login_response = cf.decode(self._socket.recv(cf._max_buffer))
+            login_response = self._run(self._api.login(login))
             logging.debug('login_response: {}'.format(login_response))
 
             if not isinstance(login_response, dict):
@@ -161,28 +159,33 @@ class GameClient:
                 self.player_name = n
                 self.player_id = login_response.get('id', '')
                 print('Hello {}!'.format(self.player_name))
+                self._run(self._api.subscribe())
                 break
 
+    def _credits(self) -> int:
+        """ Balance from the mirror kept by the server push, asked from the server without it """
+        mirror = self._api.mirror
+        return mirror.credits if mirror else self._run(self._api.get_credits())
+
     def _game(self):
         print("Let's play")
+        cr = self._credits()
         while True:
             try:
-                g = {'get': 'credits', 'player_id': self.player_id}
-                self._socket.sendall(cf.encode(g))
-
-                response = cf.decode(self._socket.recv(cf._max_buffer))
-                cr = response['credits']
-
                 bet = int(input('Your bet (from 1 to {}, 0 - exit): '.format(cr)))
 
                 if not bet:
                     break
 
-                g = {'game': bet, 'player_id': self.player_id}
-                self._socket.sendall(cf.encode(g))
-
-                response = cf.decode(self._socket.recv(cf._max_buffer))
-                if response['status'] == 'success':
+                if self._api.mirror:
+                    won = self._run(self._api.game(bet))
+                    cr = self._api.mirror.credits
+                else:
+                    # The bet and the new balance in one round trip
+                    game_response, credits_response = self._run(self._api.batch({'game': bet}, {'get': 'credits'}))
+                    won = game_response.get('status') == 'success'
+                    cr = credits_response['credits']
+                if won:
                     print('Congratulations! You win {}'.format(bet))
                 else:
                     print("Don't be upset. Try again")
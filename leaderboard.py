@@ -0,0 +1,168 @@
+""" In-memory leaderboard: richest players and most owned items, kept in indexable skiplists """
+
+import random
+
+_MAX_LEVEL = 32     # Enough for 2 ** 32 keys
+
+
+class _Node:
+    __slots__ = ('key', 'next', 'width')
+
+    def __init__(self, key, level: int):
+        self.key = key
+        self.next = [None] * level
+        self.width = [1] * level    # Keys passed by following next[i]; for None - the distance to the end
+
+
+class RankedSet:
+    """
+    Indexable skiplist: a sorted set of keys with insert, remove and rank in O(log n)
+    and the first k keys in O(log n + k)
+    usage:
+        s = RankedSet()
+        s.add((-500, 7))
+        s.rank((-500, 7)) -> 0
+        s.first(10) -> [(-500, 7)]
+    """
+
+    def __init__(self):
+        self._head = _Node(None, _MAX_LEVEL)
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @staticmethod
+    def _random_level() -> int:
+        level = 1
+        while level < _MAX_LEVEL and random.random() < 0.5:
+            level += 1
+        return level
+
+    def add(self, key):
+        """ Insert the key, it must not be in the set """
+        update = [None] * _MAX_LEVEL    # Last node before the key on every level
+        steps = [0] * _MAX_LEVEL        # Position of that node, the head is 0
+        node, pos = self._head, 0
+        for i in reversed(range(_MAX_LEVEL)):
+            while node.next[i] is not None and node.next[i].key < key:
+                pos += node.width[i]
+                node = node.next[i]
+            update[i], steps[i] = node, pos
+
+        level = self._random_level()
+        new = _Node(key, level)
+        for i in range(_MAX_LEVEL):
+            prev = update[i]
+            if i < level:
+                new.next[i] = prev.next[i]
+                prev.next[i] = new
+                new.width[i] = prev.width[i] - (pos - steps[i])
+                prev.width[i] = pos - steps[i] + 1
+            else:
+                prev.width[i] += 1
+        self._size += 1
+
+    def remove(self, key):
+        """ Remove the key, KeyError if it is not in the set """
+        update = [None] * _MAX_LEVEL
+        node = self._head
+        for i in reversed(range(_MAX_LEVEL)):
+            while node.next[i] is not None and node.next[i].key < key:
+                node = node.next[i]
+            update[i] = node
+
+        target = node.next[0]
+        if target is None or target.key != key:
+            raise KeyError(key)
+        for i in range(_MAX_LEVEL):
+            prev = update[i]
+            if prev.next[i] is target:
+                prev.width[i] += target.width[i] - 1
+                prev.next[i] = target.next[i]
+            else:
+                prev.width[i] -= 1
+        self._size -= 1
+
+    def rank(self, key):
+        """ Number of keys less than the key (0 - the first) or None if it is not in the set """
+        node, pos = self._head, 0
+        for i in reversed(range(_MAX_LEVEL)):
+            while node.next[i] is not None and node.next[i].key < key:
+                pos += node.width[i]
+                node = node.next[i]
+        node = node.next[0]
+        return pos if node is not None and node.key == key else None
+
+    def first(self, k: int) -> list:
+        """ The k smallest keys in order """
+        result = []
+        node = self._head.next[0]
+        while node is not None and len(result) < k:
+            result.append(node.key)
+            node = node.next[0]
+        return result
+
+
+class Leaderboard:
+    """
+    Players by credits and items by units owned by all players, in descending order (ties - lower id first).
+    Updated on every change, so top-K and rank of a player never scan the database.
+    Holds every player in memory: about 300 bytes each.
+    """
+
+    def __init__(self):
+        self._players = RankedSet()     # Keys (-credits, player id)
+        self._credits = {}              # Player id -> credits
+        self._nicknames = {}            # Player id -> nickname
+        self._items = RankedSet()       # Keys (-owned, item id)
+        self._owned = {}                # Item id -> units owned by all players
+
+    def load(self, players: list, owned: dict):
+        """ Rebuild from [{'id', 'nickname', 'credits'}, ...] and {item id: units owned} """
+        self._players, self._credits, self._nicknames = RankedSet(), {}, {}
+        self._items, self._owned = RankedSet(), {}
+        for player in players:
+            self.set_credits(player['id'], player['credits'], player['nickname'])
+        for item_id, count in owned.items():
+            self.add_owned(item_id, count)
+
+    def set_credits(self, player_id: int, credits_: int, nickname: str = None):
+        if nickname is not None:
+            self._nicknames[player_id] = nickname
+        old = self._credits.get(player_id)
+        if old == credits_:
+            return
+        if old is not None:
+            self._players.remove((-old, player_id))
+        self._players.add((-credits_, player_id))
+        self._credits[player_id] = credits_
+
+    def add_owned(self, item_id: int, delta: int):
+        old = self._owned.get(item_id, 0)
+        if old:
+            self._items.remove((-old, item_id))
+        if old + delta > 0:
+            self._items.add((-(old + delta), item_id))
+            self._owned[item_id] = old + delta
+        else:
+            self._owned.pop(item_id, None)
+
+    def top_players(self, k: int) -> list:
+        """ [{'id', 'nickname', 'credits'}, ...] of the k richest players """
+        return [{'id': player_id, 'nickname': self._nicknames.get(player_id, ''), 'credits': -credits_}
+                for credits_, player_id in self._players.first(k)]
+
+    def top_items(self, k: int) -> list:
+        """ [(item id, units owned), ...] of the k most owned items """
+        return [(item_id, -owned) for owned, item_id in self._items.first(k)]
+
+    def rank(self, player_id: int):
+        """ Place of the player by credits (1 - the richest) or None if unknown """
+        credits_ = self._credits.get(player_id)
+        if credits_ is None:
+            return None
+        return self._players.rank((-credits_, player_id)) + 1
+
+    def __len__(self) -> int:
+        return len(self._players)
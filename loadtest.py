@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+""" Headless load generator for GameServer.
+    Opens many concurrent sessions, every session logs in and replays the scenario (JSONL file,
+    one request per line, player_id is filled in), then reports throughput and latency per command.
+    usage:
+        python loadtest.py --sessions 2000 --iterations 5 --temp-db
+        python loadtest.py --host 127.0.0.1 --port 9099 --scenario my_mix.jsonl --json result.json
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+import time
+import projectconf as cf
+import server
+from stats import command_name
+
+
+def load_scenario(path: str) -> list:
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def with_player(request: dict, player_id: int) -> dict:
+    request = dict(request, player_id=player_id)
+    if isinstance(request.get('batch'), list):
+        request['batch'] = [with_player(r, player_id) for r in request['batch']]
+    return request
+
+
+def percentile(values: list, q: float) -> float:
+    """ q-th percentile of sorted values """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+class LoadTest:
+    def __init__(self, host: str, port: int, scenario: list, sessions: int, iterations: int,
+                 codec: str = cf.default_codec.name):
+        self.host = host
+        self.port = port
+        self.scenario = scenario
+        self.sessions = sessions
+        self.iterations = iterations
+        self.codec = codec
+        self.latencies = {}     # Command name -> list of seconds
+        self.failures = {}      # Command name -> count of {'status': 'failed'} answers
+        self.errors = 0         # Sessions broken by connection errors
+
+    def _record(self, name: str, started: float, response: dict):
+        self.latencies.setdefault(name, []).append(time.perf_counter() - started)
+        if isinstance(response, dict) and response.get('status') == 'failed':
+            self.failures[name] = self.failures.get(name, 0) + 1
+
+    @staticmethod
+    async def _call(reader, writer, request: dict, codec: cf.Codec) -> dict:
+        writer.write(cf.encode(request, codec))
+        header = await reader.readexactly(cf.header_size)
+        return cf.decode(await reader.readexactly(cf.payload_size(header)), codec)
+
+    async def _session(self, n: int):
+        try:
+            reader, writer = await asyncio.open_connection(self.host, self.port)
+        except OSError:
+            self.errors += 1
+            return
+        try:
+            codec = cf.default_codec
+            started = time.perf_counter()
+            player = await self._call(reader, writer, {'login': 'load{}'.format(n), 'codecs': [self.codec]}, codec)
+            self._record('login', started, player)
+            codec = cf.choose_codec([player.get('codec', codec.name)])
+
+            for _ in range(self.iterations):
+                for request in self.scenario:
+                    started = time.perf_counter()
+                    response = await self._call(reader, writer, with_player(request, player['id']), codec)
+                    self._record(command_name(request), started, response)
+
+            writer.write(cf.encode({'logout': player['nickname']}, codec))
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError, KeyError):
+            self.errors += 1
+        finally:
+            writer.close()
+
+    async def run(self) -> float:
+        started = time.perf_counter()
+        await asyncio.gather(*(self._session(n) for n in range(self.sessions)))
+        return time.perf_counter() - started
+
+    def report(self, elapsed: float) -> dict:
+        result = {'sessions': self.sessions, 'elapsed': elapsed, 'errors': self.errors, 'commands': {}}
+        for name, values in sorted(self.latencies.items()):
+            values.sort()
+            result['commands'][name] = {
+                'count': len(values),
+                'failed': self.failures.get(name, 0),
+                'rps': len(values) / elapsed,
+                'p50': percentile(values, 50),
+                'p95': percentile(values, 95),
+                'p99': percentile(values, 99),
+                'max': values[-1],
+            }
+        result['total_rps'] = sum(len(v) for v in self.latencies.values()) / elapsed
+        return result
+
+
+def print_report(result: dict):
+    print('Sessions: {}, elapsed {:.2f} s, connection errors: {}'.format(
+        result['sessions'], result['elapsed'], result['errors']))
+    print('{:<16}{:>9}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}'.format(
+        'command', 'count', 'failed', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+    for name, c in result['commands'].items():
+        print('{:<16}{:>9}{:>8}{:>10.0f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(
+            name, c['count'], c['failed'], c['rps'], c['p50'] * 1000, c['p95'] * 1000, c['p99'] * 1000,
+            c['max'] * 1000))
+    print('Total: {:.0f} requests/s'.format(result['total_rps']))
+
+
+def _create_db(base_name: str, shards: int):
+    for name in server.shard_names(base_name, shards):
+        db = server.DataBase(name)
+        db.migrate()
+        db.create_items()
+        db.close()
+
+
+def _run_server(host: str, port: int, base_name: str, workers: int, shards: int):
+    if workers > 1:
+        server.Supervisor(workers, host, port, base_name, shards).start()
+    else:
+        server.GameServer(host, port, base_name=base_name, shards=shards).start()
+
+
+def start_temp_server(host: str, workers: int, shards: int = cf.shards) -> tuple:
+    """ Start a server on a fresh SQLite file in a temporary directory, returns (process, port, directory) """
+    directory = tempfile.mkdtemp(prefix='game_loadtest_')
+    base_name = os.path.join(directory, 'game_storage.sqlite3')
+    # In a child process: SQLite state must not be carried over fork into the server
+    p = multiprocessing.Process(target=_create_db, args=(base_name, shards))
+    p.start()
+    p.join()
+
+    with socket.socket() as s:
+        s.bind((host, 0))
+        port = s.getsockname()[1]
+
+    p = multiprocessing.Process(target=_run_server, args=(host, port, base_name, workers, shards))
+    p.start()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return p, port, directory
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test for the game server')
+    parser.add_argument('--host', default=cf.host)
+    parser.add_argument('--port', type=int, default=cf.port)
+    parser.add_argument('--scenario', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                           'loadtest_scenario.jsonl'))
+    parser.add_argument('--sessions', type=int, default=1000, help='concurrent sessions')
+    parser.add_argument('--iterations', type=int, default=1, help='scenario replays per session')
+    parser.add_argument('--codec', default=cf.default_codec.name, choices=sorted(cf.codecs))
+    parser.add_argument('--temp-db', action='store_true',
+                        help='start own server on a temporary SQLite file instead of using --port')
+    parser.add_argument('--workers', type=int, default=1, help='server processes with --temp-db')
+    parser.add_argument('--shards', type=int, default=cf.shards, help='database files with --temp-db')
+    parser.add_argument('--json', help='also write the results to this file, for comparing commits')
+    args = parser.parse_args()
+
+    process = None
+    if args.temp_db:
+        process, args.port, directory = start_temp_server(args.host, args.workers, args.shards)
+        print('Temporary server on port {}, database in {}'.format(args.port, directory))
+
+    test = LoadTest(args.host, args.port, load_scenario(args.scenario), args.sessions, args.iterations, args.codec)
+    loop = asyncio.get_event_loop()
+    try:
+        result = test.report(loop.run_until_complete(test.run()))
+    finally:
+        loop.close()
+        if process:
+            process.terminate()
+            process.join(cf.shutdown_timeout)
+
+    print_report(result)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2)
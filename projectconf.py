@@ -1,25 +1,103 @@
+import collections
 import json
+import struct
+import binpack
+
+try:
+    import msgpack                  # Optional: C implementation of the binary codec
+except ImportError:
+    msgpack = None
 
 
 """ Settings for coordinated work ClientCarCenter и ServerCarCenter """
-_max_buffer = 4096                  # Receive buffer for socket
+_header = struct.Struct('!I')       # Frame header: payload length in network byte order
+header_size = _header.size
+max_frame = 16 * 1024 * 1024        # Largest accepted payload, bytes
+max_pipeline = 64                   # Requests in flight per connection
+page_size = 100                     # Items per message of a streamed listing
+max_page = 1000                     # Largest page of a paginated listing
+preferred_codecs = ('msgpack', 'json')  # Wire codecs offered by the client at login, best first (if installed)
 
 default_credits = 500               # Default credits when creating a user
 pers_win = 80                       # Win percentage of the game
 
 base_name = 'game_storage.sqlite3'  # Name database
+shards = 1                          # SQLite files the players are spread over: game_storage.0.sqlite3 ...; 1 - one file
+db_readers = 4                      # Read-only connections serving reads off the event loop
+group_commit = True                 # Commit writes of concurrent requests together
+commit_window = 0.005               # Longest wait for more writes before commit, seconds (durability delay)
+commit_batch = 256                  # Most writes in one commit
+busy_timeout = 5.0                  # Longest wait for the write lock held by another process, seconds
+write_behind = False                # Serve logged-in players from memory, flush their changes periodically
+write_behind_interval = 1.0         # Flush period, seconds: the most recent changes a crash may lose
+response_cache_size = 10000         # Encoded answers about players (inventory, ...) kept in memory; 0 - disabled
+ledger = False                      # Append credit changes to the ledger table instead of updating balances
+snapshot_interval = 10.0            # How often balances are materialized from the ledger, seconds
 
 host = '127.0.0.1'                  # Server parameters
 port = 9099
+supervisor_interval = 1.0           # How often the supervisor checks its workers, seconds
+leaderboard_interval = 60.0         # How often a worker of the supervisor reloads the leaderboard, seconds
+shutdown_timeout = 10.0             # Time given to a worker for graceful stop, seconds
+max_connections = 10000             # Connections served at once, more wait for a free slot
+idle_timeout = 300.0                # Connections without requests for so long are closed, seconds
+rate_limit = 1000.0                 # Requests per second of one connection, excess requests wait; 0 - unlimited
+rate_burst = 100                    # Requests a connection may send at once above the rate
+admin_hosts = ('127.0.0.1', '::1')  # Peer addresses allowed to run admin commands (reload, stats); () - nobody
+client_pool_size = 4                # Connections of AsyncGameClient
+client_timeout = 10.0               # Seconds to wait for an answer
+client_retries = 2                  # Repeats of a read request after a connection error
+client_retry_delay = 0.5            # Seconds between the repeats
+stats_file = None                   # Periodic stats dump, e.g. 'stats_{pid}.json'; None - disabled
+stats_interval = 60.0               # Seconds between stats dumps
+
+
+Codec = collections.namedtuple('Codec', 'name dumps loads')
+codecs = {}                         # Registry of wire codecs: name -> Codec
+
+
+def register_codec(name: str, dumps, loads) -> Codec:
+    codecs[name] = Codec(name, dumps, loads)
+    return codecs[name]
+
+
+default_codec = register_codec('json',
+                               lambda d: json.dumps(d, ensure_ascii=False).encode('utf-8'),
+                               lambda b: json.loads(b.decode('utf-8')))
+if msgpack:
+    register_codec('msgpack', lambda d: msgpack.packb(d, use_bin_type=True), lambda b: msgpack.unpackb(b, raw=False))
+# Same wire format in pure python: several times slower than json, so never offered by default
+register_codec('binpack', binpack.packb, binpack.unpackb)
+preferred_codecs = tuple(name for name in preferred_codecs if name in codecs)  # Offer only the available ones
+
+
+def choose_codec(names) -> Codec:
+    """ First known codec of the names offered by the client, JSON if there is none or names is not a list """
+    if not isinstance(names, list):
+        return default_codec
+    for name in names:
+        if isinstance(name, str) and name in codecs:
+            return codecs[name]
+    return default_codec
+
+
+def encode(d: dict, codec: Codec = default_codec) -> bytes:  # Necessary for equal encode/decode
+    """ Serialize message into a length-prefixed frame """
+    j = codec.dumps(d)
+    return _header.pack(len(j)) + j
 
 
-def encode(d: dict) -> bytes:       # Necessary for equal encode/decode
-    j = json.dumps(d, ensure_ascii=False)
-    return j.encode('utf-8')
+def decode(b: bytes, codec: Codec = default_codec) -> dict:
+    """ Deserialize frame payload (without header) """
+    return codec.loads(b)
 
 
-def decode(b: bytes) -> dict:
-    return json.loads(b, encoding='utf-8')
+def payload_size(header: bytes) -> int:
+    """ Payload length announced by frame header """
+    size, = _header.unpack(header)
+    if size > max_frame:
+        raise ValueError('Frame too large: {}'.format(size))
+    return size
 
 
 items = (
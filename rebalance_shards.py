@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+""" Split a database into shard files (see server.ShardedDataBase), or re-split shards into a new count.
+    Players are placed by the hash of the nickname and get new ids congruent to their shard number,
+    their items and ledger move with them, the items catalog is copied to every shard.
+    Run with the server stopped. Source files are only brought to the current schema and snapshotted.
+    usage:
+        python rebalance_shards.py --shards 4
+        python rebalance_shards.py --source old.sqlite3 --source-shards 4 --shards 8
+    then set cf.shards to the new count
+"""
+
+import argparse
+import os
+import projectconf as cf
+import server
+
+
+def rebalance(source: str, target: str, shards: int, source_shards: int = 1) -> list:
+    """ Copy the source database(s) to new shard files, returns the number of players of every shard """
+    sources = server.shard_names(source, source_shards)
+    targets = server.shard_names(target, shards)
+    if shards < 2:
+        raise ValueError('At least 2 shards are required')
+    existing = [name for name in targets if os.path.exists(name)]
+    if existing:
+        raise ValueError('Target files exist: {}'.format(', '.join(existing)))
+
+    dbs = [server.DataBase(name, shard=n, shards=shards) for n, name in enumerate(targets)]
+    counts = [0] * shards
+    next_ids = [n + shards for n in range(shards)]  # As DataBase.create_player would assign them
+    try:
+        for db in dbs:
+            db.migrate()
+        for number, name in enumerate(sources):
+            src = server.DataBase(name)
+            src.migrate()
+            src.snapshot()  # Balances include the whole ledger, copied entries are history only
+            if not number:
+                items = src.conn.execute("SELECT id, name, price, description FROM items").fetchall()
+                for db in dbs:
+                    db.conn.executemany("INSERT INTO items (id, name, price, description) "
+                                        "VALUES (:id, :name, :price, :description)", items)
+
+            new_ids = {}  # Source id -> (shard, new id)
+            for player in src.conn.execute("SELECT id, nickname, credits FROM players ORDER BY id").fetchall():
+                shard = server.nickname_shard(player['nickname'], shards)
+                new_ids[player['id']] = shard, next_ids[shard]
+                dbs[shard].conn.execute("INSERT INTO players (id, nickname, credits) VALUES (?, ?, ?)",
+                                        (next_ids[shard], player['nickname'], player['credits']))
+                next_ids[shard] += shards
+                counts[shard] += 1
+
+            for row in src.conn.execute("SELECT player_id, item_id, quantity FROM inventory"):
+                shard, player_id = new_ids[row['player_id']]
+                dbs[shard].conn.execute("INSERT INTO inventory (player_id, item_id, quantity) VALUES (?, ?, ?)",
+                                        (player_id, row['item_id'], row['quantity']))
+
+            for row in src.conn.execute("SELECT player_id, delta, reason, item_id, created_at FROM ledger "
+                                        "ORDER BY seq"):
+                shard, player_id = new_ids[row['player_id']]
+                dbs[shard].conn.execute("INSERT INTO ledger (player_id, delta, reason, item_id, created_at) "
+                                        "VALUES (?, ?, ?, ?, ?)",
+                                        (player_id, row['delta'], row['reason'], row['item_id'], row['created_at']))
+            src.close()
+
+        for db in dbs:
+            db.conn.execute("UPDATE players SET ledger_seq=COALESCE("
+                            "(SELECT MAX(seq) FROM ledger WHERE ledger.player_id=players.id), 0)")
+    finally:
+        for db in dbs:
+            db.close()
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Spread the players of a database over shard files')
+    parser.add_argument('--source', default=cf.base_name, help='database to split')
+    parser.add_argument('--source-shards', type=int, default=1, help='shard count of the source')
+    parser.add_argument('--target', default=cf.base_name, help='base name of the new shard files')
+    parser.add_argument('--shards', type=int, required=True, help='new shard count')
+    args = parser.parse_args()
+
+    try:
+        result = rebalance(args.source, args.target, args.shards, args.source_shards)
+    except ValueError as e:
+        parser.error(str(e))
+    for name, count in zip(server.shard_names(args.target, args.shards), result):
+        print('{}: {} players'.format(name, count))
@@ -1,190 +1,976 @@
 #!/srv/anaconda3/bin/python3.7
 
 import asyncio
-import sqlite3
+import bisect
+import collections
+import contextlib
 import json
+import os
+import queue
+import sqlite3
 import logging
+import multiprocessing
 import random
+import secrets
+import signal
+import threading
+import time
+import types
+import zlib
 import projectconf as cf
+from stats import stats, command_name
+from leaderboard import Leaderboard
+from concurrent.futures import Future, ThreadPoolExecutor
 
 logging.disable(logging.CRITICAL)
 # logging.basicConfig(level=logging.DEBUG)
 
 
+# Schema migrations: (version, statements). Applied in order by DataBase.migrate(),
+# an applied migration must never be changed - add a new one instead
+MIGRATIONS = (
+    (1, ("CREATE TABLE IF NOT EXISTS players ("
+         "id integer primary key,"
+         "nickname varchar(20) unique,"
+         "credits integer not null);",
+         "CREATE TABLE IF NOT EXISTS items ("
+         "id integer primary key,"
+         "name varchar(100) not null,"
+         "price integer not null,"
+         "description text);",
+         "CREATE TABLE IF NOT EXISTS player_items ("
+         "trans_id integer primary key,"
+         "player_id integer not null,"
+         "item_id integer not null,"
+         "foreign key (player_id) references players(id),"
+         "foreign key (item_id)  references items(id));")),
+    (2, ("CREATE INDEX IF NOT EXISTS player_items_player_item ON player_items (player_id, item_id);",)),
+    (3, ("CREATE TABLE ledger ("
+         "seq integer primary key,"
+         "player_id integer not null,"
+         "delta integer not null,"
+         "reason varchar(20) not null,"
+         "item_id integer,"
+         "created_at timestamp default current_timestamp);",
+         "CREATE INDEX ledger_player_seq ON ledger (player_id, seq);",
+         # players.credits is the balance as of ledger entry players.ledger_seq (snapshot)
+         "ALTER TABLE players ADD COLUMN ledger_seq integer not null default 0;")),
+    # One row per owned item with a quantity instead of one row per purchase
+    (4, ("CREATE TABLE inventory ("
+         "player_id integer not null,"
+         "item_id integer not null,"
+         "quantity integer not null,"
+         "primary key (player_id, item_id),"
+         "foreign key (player_id) references players(id),"
+         "foreign key (item_id)  references items(id)) WITHOUT ROWID;",
+         "INSERT INTO inventory (player_id, item_id, quantity) "
+         "SELECT player_id, item_id, COUNT(*) FROM player_items GROUP BY player_id, item_id;",
+         "DROP TABLE player_items;")),
+)
+
+# Current balance: snapshot plus the ledger tail after it
+_BALANCE = ("players.credits + COALESCE((SELECT SUM(delta) FROM ledger "
+            "WHERE ledger.player_id=players.id AND ledger.seq > players.ledger_seq), 0)")
+
+# Largest value of an SQLite INTEGER, bigger Python ints can not be bound
+_MAX_INTEGER = 2 ** 63 - 1
+
+
+def shard_names(base_name: str, shards: int = cf.shards) -> list:
+    """ Database files of the shards: game_storage.0.sqlite3, game_storage.1.sqlite3 ...; one shard is base_name """
+    if shards <= 1:
+        return [base_name]
+    root, ext = os.path.splitext(base_name)
+    return ['{}.{}{}'.format(root, n, ext) for n in range(shards)]
+
+
+def nickname_shard(nickname: str, shards: int) -> int:
+    """ Shard of a new player: stable hash of the nickname (unlike hash(), the same in every process) """
+    return zlib.crc32(nickname.encode('utf-8')) % shards
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Cursor of DataBase: records latency of every SQL statement into stats and returns rows as dicts.
+    Rows are fetched as plain tuples and zipped with the column names taken once per statement,
+    instead of a row_factory walking cursor.description for every row
+    """
+    _names = {}     # SQL text -> histogram name
+    _columns = ()   # Column names of the last statement
+
+    def execute(self, sql, parameters=()):
+        self.row_factory = None  # Connection.cursor() sets the factory of the connection after __init__
+        started = time.perf_counter()
+        try:
+            result = super().execute(sql, parameters)
+        finally:
+            self._observe(sql, started)
+        description = self.description
+        self._columns = tuple(column[0] for column in description) if description else ()
+        return result
+
+    def fetchone(self):
+        row = super().fetchone()
+        return row if row is None else dict(zip(self._columns, row))
+
+    def fetchall(self) -> list:
+        columns = self._columns
+        return [dict(zip(columns, row)) for row in super().fetchall()]
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._observe(sql, started)
+
+    def _observe(self, sql: str, started: float):
+        name = self._names.get(sql)
+        if name is None:
+            name = self._names[sql] = 'sql ' + ' '.join(sql.split())
+        stats.observe(name, time.perf_counter() - started)
+
+
 class DataBase:
     """ Layer for working with a database """
 
-    def __init__(self, base_name: str = cf.base_name):
-        self.conn = sqlite3.connect(base_name)  # Connection
+    def __init__(self, base_name: str = cf.base_name, readonly: bool = False, ledger: bool = cf.ledger,
+                 shard: int = 0, shards: int = 1):
+        # Reader connections may be used from any thread of the reader pool, but only by one at a time
+        self.conn = sqlite3.connect(base_name, timeout=cf.busy_timeout, check_same_thread=False)  # Connection
+        if readonly:
+            # Not mode=ro: a read-only connection can not maintain the WAL index and fails with disk I/O errors
+            self.conn.execute('PRAGMA query_only=ON')
+        else:
+            self.conn.execute('PRAGMA journal_mode=WAL')  # Readers do not block the writer and vice versa
         logging.debug("Base client: {}".format(self.conn))
 
         def dict_factory(cursor, row) -> dict:
-            """ Func for row_factory """
+            """ Func for row_factory, for statements run with conn.execute(); cursors of _cursor() are faster """
             d = {}
             for idx, col in enumerate(cursor.description):
                 d[col[0]] = row[idx]
             return d
 
         self.conn.row_factory = dict_factory
-        self.cursor = self.conn.cursor()  # Cursor
+        self.autocommit = True  # False while AsyncDataBase runs a group commit batch
+        self.ledger = ledger    # Append credit changes to the ledger instead of updating players
+        self.shard = shard      # Number of this file among the shards, player ids here are shard + k * shards
+        self.shards = shards
 
     def close(self):
         self.conn.commit()
         self.conn.close()
 
+    def _cursor(self) -> TimedCursor:
+        """ New cursor for every call: results of a shared cursor would be overwritten by the next statement """
+        return self.conn.cursor(TimedCursor)
+
+    @contextlib.contextmanager
+    def _snapshot(self):
+        """ Reads inside see one committed state of the database (a WAL read transaction), never wait for writers """
+        self.conn.execute('BEGIN')
+        try:
+            yield
+        finally:
+            self.conn.commit()
+
+    def _commit(self):
+        if self.autocommit:
+            with stats.timer('db commit'):
+                self.conn.commit()
+
+    @contextlib.contextmanager
+    def _atomic(self):
+        """ Statements inside are applied all or nothing, then committed (unless a batch is running) """
+        self.conn.execute('SAVEPOINT atomic')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK TO atomic')
+            raise
+        finally:
+            self.conn.execute('RELEASE atomic')
+        self._commit()
+
     def create_items(self):
         """ re-create table items """
+        cursor = self._cursor()
         items_prop = [list(i.values()) for i in cf.items]
 
-        self.cursor.execute("DELETE FROM items")
-        self.cursor.executemany("INSERT INTO items (name, price) "
-                                "VALUES (?, ?)", items_prop)
+        cursor.execute("DELETE FROM items")
+        cursor.executemany("INSERT INTO items (name, price) "
+                           "VALUES (?, ?)", items_prop)
 
     def create_tables(self):
-        """ re-create tables """
-        # self.cursor.execute("DROP TABLE player_items")
-        # self.cursor.execute("DROP TABLE players")
-        # self.cursor.execute("DROP TABLE items")
-
-        self.cursor.execute("CREATE TABLE players ("
-                            "id integer primary key,"
-                            "nickname varchar(20) unique,"
-                            "credits integer not null);"
-                            "")
-        self.cursor.execute("CREATE TABLE items ("
-                            "id integer primary key,"
-                            "name varchar(100) not null,"
-                            "price integer not null,"
-                            "description text);"
-                            "")
-        self.cursor.execute("CREATE TABLE player_items ("
-                            "trans_id integer primary key,"
-                            "player_id integer not null,"
-                            "item_id integer not null,"
-                            "foreign key (player_id) references players(id),"
-                            "foreign key (item_id)  references items(id));"
-                            "")
+        """ create tables of the current schema (on an empty or an older database) """
+        self.migrate()
+
+    def migrate(self) -> int:
+        """ Apply migrations newer than the schema version of the database, returns the new version """
+        cursor = self._cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS schema_version ("
+                       "version integer primary key,"
+                       "applied_at timestamp default current_timestamp);"
+                       "")
+        cursor.execute("SELECT MAX(version) AS version FROM schema_version")
+        version = cursor.fetchone()['version'] or 0
+
+        for number, statements in MIGRATIONS:
+            if number <= version:
+                continue
+            logging.debug("Migrate schema to version {}".format(number))
+            with self._atomic():
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute("INSERT INTO schema_version (version) VALUES (:number)",
+                               {'number': number})
+            version = number
+        return version
 
     def get_player(self, nickname: str = '', id_: int = 0) -> dict:
+        cursor = self._cursor()
         if id_:
-            self.cursor.execute("SELECT * FROM players WHERE id=:id",
-                                {'id': id_})
+            cursor.execute("SELECT id, nickname, " + _BALANCE + " AS credits "
+                           "FROM players WHERE id=:id",
+                           {'id': id_})
         elif nickname:
-            self.cursor.execute('SELECT * FROM players WHERE nickname=:nickname',
-                                {'nickname': nickname})
+            cursor.execute("SELECT id, nickname, " + _BALANCE + " AS credits "
+                           "FROM players WHERE nickname=:nickname",
+                           {'nickname': nickname})
         else:
             return {}
 
-        result = self.cursor.fetchone()
+        result = cursor.fetchone()
         if result:
             return result
         else:
             return {}
 
     def create_player(self, nickname: str, credits_: int = cf.default_credits) -> dict:
+        cursor = self._cursor()
         try:
-            self.cursor.execute("INSERT INTO players (nickname, credits) "
-                                "VALUES (:nickname, :credits)",
-                                {'nickname': nickname, 'credits': credits_})
+            # Concurrent logins with a new nickname must all get the same player
+            if self.shards > 1:
+                # Ids of a shard are congruent to its number, so the shard of any player is id % shards
+                cursor.execute("INSERT OR IGNORE INTO players (id, nickname, credits) "
+                               "VALUES ((SELECT COALESCE(MAX(id), :shard) + :shards FROM players), "
+                               ":nickname, :credits)",
+                               {'shard': self.shard, 'shards': self.shards,
+                                'nickname': nickname, 'credits': credits_})
+            else:
+                cursor.execute("INSERT OR IGNORE INTO players (nickname, credits) "
+                               "VALUES (:nickname, :credits)",
+                               {'nickname': nickname, 'credits': credits_})
         except sqlite3.DatabaseError as e:
             logging.error("create_player error: {}".format(e.args))
             return {}
 
-        self.conn.commit()
+        self._commit()
         return self.get_player(nickname)
 
-    def buy_item(self, player_id_: int, item_id_: int) -> dict:
+    def buy_item(self, player_id_: int, item_id_: int, price: int) -> dict:
+        """ Answer with the new balance ('credits', 'delta') and the new 'quantity' of the item """
+        cursor = self._cursor()
         try:
-            player = self.get_player(id_=player_id_)
-            cost = self.get_cost(item_id_)
-            balance = player.get('credits', 0) - cost.get('price', 99999)
-
-            if balance < 0:
-                return {'status': 'failed'}
+            with self._atomic():
+                change = self._change_credits(player_id_, -price, stake=price, reason='buy', item_id_=item_id_)
+                if not change:
+                    return {'status': 'failed'}
 
-            self.cursor.execute("INSERT INTO player_items (player_id, item_id) "
-                                "VALUES (:player_id_, :item_id_)",
-                                {'player_id_': player_id_, 'item_id_': item_id_})
-
-            self.set_balance(player_id_, balance)
+                params = {'player_id_': player_id_, 'item_id_': item_id_}
+                cursor.execute("UPDATE inventory SET quantity=quantity + 1 "
+                               "WHERE player_id=:player_id_ AND item_id=:item_id_", params)
+                if cursor.rowcount:
+                    quantity = self._quantity(player_id_, item_id_)
+                else:
+                    cursor.execute("INSERT INTO inventory (player_id, item_id, quantity) "
+                                   "VALUES (:player_id_, :item_id_, 1)", params)
+                    quantity = 1
 
         except sqlite3.DatabaseError as e:
             logging.error("buy_item error: {}".format(e.args))
             return {'status': 'failed'}
 
-        self.conn.commit()
-        return {'status': 'success'}
+        return dict(change, status='success', quantity=quantity)
 
-    def sell_item(self, player_id_: int, item_id_: int) -> dict:
+    def sell_item(self, player_id_: int, item_id_: int, price: int) -> dict:
+        """ Sell one unit of the item, answer like buy_item """
+        cursor = self._cursor()
         try:
-            player = self.get_player(id_=player_id_)
-            cost = self.get_cost(item_id_)
-            balance = player.get('credits', 0) + cost.get('price', 0)
+            with self._atomic():
+                params = {'player_id_': player_id_, 'item_id_': item_id_}
+                cursor.execute("UPDATE inventory SET quantity=quantity - 1 "
+                               "WHERE player_id=:player_id_ AND item_id=:item_id_ AND quantity > 0", params)
+                if not cursor.rowcount:
+                    return {'status': 'failed'}
+                quantity = self._quantity(player_id_, item_id_)
+                if not quantity:
+                    cursor.execute("DELETE FROM inventory "
+                                   "WHERE player_id=:player_id_ AND item_id=:item_id_", params)
 
-            if balance < 0:
-                return {'status': 'failed'}
+                change = self._change_credits(player_id_, price, reason='sell', item_id_=item_id_)
+                if not change:
+                    raise sqlite3.DatabaseError('no player {}'.format(player_id_))
 
-            self.cursor.execute("SELECT * FROM player_items "
-                                "WHERE player_id=:player_id_ and item_id=:item_id_",
-                                {'player_id_': player_id_, 'item_id_': item_id_})
+        except sqlite3.DatabaseError as e:
+            logging.error("sell_item error: {}".format(e.args))
+            return {'status': 'failed'}
 
-            if not self.cursor.fetchone():
-                return {'status': 'failed'}
+        return dict(change, status='success', quantity=quantity)
 
-            self.cursor.execute("DELETE FROM player_items "
-                                "WHERE player_id=:player_id_ and item_id=:item_id_",
-                                {'player_id_': player_id_, 'item_id_': item_id_})
+    def _quantity(self, player_id_: int, item_id_: int) -> int:
+        cursor = self._cursor()
+        cursor.execute("SELECT quantity FROM inventory WHERE player_id=:player_id_ AND item_id=:item_id_",
+                       {'player_id_': player_id_, 'item_id_': item_id_})
+        row = cursor.fetchone()
+        return row['quantity'] if row else 0
 
-            self.set_balance(player_id_, balance)
+    def change_credits(self, player_id_: int, delta: int, stake: int = 0, floor: int = 0,
+                       reason: str = 'credits') -> dict:
+        """ Add delta (may be negative) to credits if the player has at least stake credits,
+            answer with the new balance 'credits' and the applied 'delta' """
+        try:
+            with self._atomic():
+                change = self._change_credits(player_id_, delta, stake, floor, reason)
+                if not change:
+                    return {'status': 'failed'}
 
         except sqlite3.DatabaseError as e:
-            logging.error("sell_item error: {}".format(e.args))
+            logging.error("change_credits error: {}".format(e.args))
             return {'status': 'failed'}
 
-        self.conn.commit()
-        return {'status': 'success'}
+        return dict(change, status='success')
 
-    def get_cost(self, item_id_: int) -> dict:
-        self.cursor.execute("SELECT price FROM items WHERE id=:id",
-                            {'id': item_id_})
-        result = self.cursor.fetchone()
-        if result:
-            return result
-        else:
-            return {}
+    def _change_credits(self, player_id_: int, delta: int, stake: int = 0, floor: int = 0,
+                        reason: str = 'credits', item_id_: int = None) -> dict:
+        """
+        Returns {'credits': new balance, 'delta': applied change} or {} if the player has less than stake.
+        The stake is checked by the write statement itself, so concurrent requests can not spend the same credits twice
+        """
+        cursor = self._cursor()
+        params = {'player_id_': player_id_, 'delta': delta, 'stake': stake, 'floor': floor,
+                  'reason': reason, 'item_id_': item_id_}
+        if self.ledger:
+            cursor.execute("INSERT INTO ledger (player_id, delta, reason, item_id) "
+                           "SELECT :player_id_, MAX(balance + :delta, :floor) - balance, :reason, :item_id_ "
+                           "FROM (SELECT " + _BALANCE + " AS balance FROM players WHERE id=:player_id_) "
+                           "WHERE balance >= :stake", params)
+            if not cursor.rowcount:
+                return {}
+            cursor.execute("SELECT ledger.delta, " + _BALANCE + " AS credits "
+                           "FROM ledger JOIN players ON players.id=ledger.player_id WHERE ledger.seq=:seq",
+                           {'seq': cursor.lastrowid})
+            return cursor.fetchone()
 
-    def get_items(self, player_id_: int) -> dict:
-        self.cursor.execute("""SELECT * FROM items WHERE id NOT IN
-                                    (SELECT item_id FROM player_items
-                                    WHERE player_id=:player_id_)""", {'player_id_': player_id_})
-        result = self.cursor.fetchall()
-        if result:
-            return {'items': result}
-        else:
+        # Only a floored loss can apply less than delta, then the previous balance is read in the same transaction
+        previous = None
+        if stake + delta < floor:
+            cursor.execute("SELECT credits FROM players WHERE id=:player_id_", params)
+            row = cursor.fetchone()
+            if not row:
+                return {}
+            previous = row['credits']
+        cursor.execute("UPDATE players SET credits=MAX(credits + :delta, :floor) "
+                       "WHERE id=:player_id_ AND credits >= :stake", params)
+        if not cursor.rowcount:
             return {}
+        cursor.execute("SELECT credits FROM players WHERE id=:player_id_", params)
+        credits_ = cursor.fetchone()['credits']
+        return {'credits': credits_, 'delta': delta if previous is None else credits_ - previous}
 
-    def get_player_items(self, player_id_: int) -> dict:
-        self.cursor.execute("""SELECT * FROM items WHERE id IN
-                            (SELECT item_id FROM player_items
-                            WHERE player_id=:player_id_)""", {'player_id_': player_id_})
-        result = self.cursor.fetchall()
-        credits_ = self.get_player(id_=player_id_)['credits']
-        return {'items': result, 'credits': credits_}
+    def snapshot(self) -> int:
+        """ Fold the ledger tails into players.credits, returns the number of updated players """
+        cursor = self._cursor()
+        try:
+            with self._atomic():
+                cursor.execute("UPDATE players SET "
+                               "credits=" + _BALANCE + ","
+                               "ledger_seq=(SELECT MAX(seq) FROM ledger WHERE ledger.player_id=players.id) "
+                               "WHERE EXISTS (SELECT 1 FROM ledger WHERE ledger.player_id=players.id "
+                               "AND ledger.seq > players.ledger_seq)")
+                updated = cursor.rowcount
+        except sqlite3.DatabaseError as e:
+            logging.error("snapshot error: {}".format(e.args))
+            return 0
+        return updated
+
+    def get_history(self, player_id_: int, limit: int = 20) -> dict:
+        """ Latest ledger entries of the player, newest first """
+        cursor = self._cursor()
+        cursor.execute("SELECT seq, delta, reason, item_id, created_at FROM ledger "
+                       "WHERE player_id=:player_id_ ORDER BY seq DESC LIMIT :limit",
+                       {'player_id_': player_id_, 'limit': limit})
+        return {'history': cursor.fetchall()}
+
+    def get_catalog(self) -> list:
+        cursor = self._cursor()
+        cursor.execute("SELECT * FROM items ORDER BY id")
+        return cursor.fetchall()
+
+    def get_player_item_counts(self, player_id_: int) -> dict:
+        """ Owned items: item id -> quantity """
+        cursor = self._cursor()
+        cursor.execute("SELECT item_id, quantity FROM inventory WHERE player_id=:player_id_",
+                       {'player_id_': player_id_})
+        return {row['item_id']: row['quantity'] for row in cursor.fetchall()}
+
+    def get_player_state(self, player_id_: int) -> dict:
+        """ Balance and owned items [[item id, quantity], ...] in one answer, the starting point of a subscriber """
+        items = self.get_player_item_counts(player_id_)
+        return {'credits': self.get_player(id_=player_id_).get('credits'), 'items': sorted(map(list, items.items()))}
+
+    def get_leaderboard(self) -> dict:
+        """ Balances of all players and units owned of every item: full scans, only to rebuild the leaderboard """
+        cursor = self._cursor()
+        cursor.execute("SELECT id, nickname, " + _BALANCE + " AS credits FROM players")
+        players = cursor.fetchall()
+        cursor.execute("SELECT item_id, SUM(quantity) AS owned FROM inventory GROUP BY item_id")
+        return {'players': players, 'items': {row['item_id']: row['owned'] for row in cursor.fetchall()}}
+
+    def apply(self, ops: list) -> int:
+        """ Replay journaled write operations [(method name, player id, args), ...], returns count of failed """
+        failed = 0
+        for method, player_id_, args in ops:
+            if getattr(self, method)(player_id_, *args).get('status') != 'success':
+                logging.error("apply error: {} {} {}".format(method, player_id_, args))
+                failed += 1
+        return failed
 
     def get_credits(self, id_: int) -> dict:
         credits_ = self.get_player(id_=id_)['credits']
         return {'credits': credits_}
 
-    def set_balance(self, player_id_: int, balance: int) -> dict:
+
+class AsyncDataBase:
+    """
+    Asynchronous layer over DataBase for the event loop.
+    All writes are serialized on a dedicated writer thread with its own connection,
+    reads are spread over a pool of read-only connections (WAL mode lets them run alongside writes).
+    Every read call runs in its own read transaction, so all its statements see the same committed snapshot.
+
+    Group commit: the writer gathers writes of concurrent requests for up to cf.commit_window seconds
+    or cf.commit_batch operations, runs them in one transaction (each inside its own savepoint)
+    and commits once. Every caller is answered only after its batch is committed.
+    """
+
+    def __init__(self, base_name: str = cf.base_name, readers: int = cf.db_readers, ledger: bool = cf.ledger,
+                 shard: int = 0, shards: int = 1):
+        self._db = DataBase(base_name, ledger=ledger, shard=shard, shards=shards)  # Writer connection, must be created first: it switches the file to WAL
+        self._ops = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='db-writer', daemon=True)
+        self._writer.start()
+        self._readers = ThreadPoolExecutor(readers, 'db-reader')
+        self._pool = queue.Queue()
+        for _ in range(readers):
+            self._pool.put(DataBase(base_name, readonly=True))
+
+    def close(self):
+        self._ops.put(None)
+        self._writer.join()
+        self._db.close()
+        self._readers.shutdown()
+        while not self._pool.empty():
+            self._pool.get().conn.close()
+
+    def _read_in_thread(self, func, args):
+        db = self._pool.get()
         try:
-            self.cursor.execute("UPDATE players SET credits=:balance "
-                                "WHERE id=:player_id_",
-                                {'balance': balance, 'player_id_': player_id_})
+            with db._snapshot():
+                return func(db, *args)
+        finally:
+            self._pool.put(db)
+
+    async def _read(self, func, *args):
+        loop = asyncio.get_event_loop()
+        with stats.timer('db read'):  # Including the wait for a free reader
+            return await loop.run_in_executor(self._readers, self._read_in_thread, func, args)
+
+    async def _write(self, func, *args):
+        future = Future()
+        with stats.timer('db write'):  # Including the wait for the batch commit
+            self._ops.put((future, func, args))
+            return await asyncio.wrap_future(future)
+
+    def _next_batch(self) -> list:
+        """ Wait for a write, then gather more until the batch is full or the commit window expires """
+        op = self._ops.get()
+        if op is None:
+            return []
+        batch = [op]
+        if not cf.group_commit:
+            return batch
+        deadline = time.monotonic() + cf.commit_window
+        while len(batch) < cf.commit_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                op = self._ops.get(timeout=timeout) if timeout > 0 else self._ops.get_nowait()
+            except queue.Empty:
+                break
+            if op is None:
+                self._ops.put(None)  # Stop after this batch
+                break
+            batch.append(op)
+        return batch
+
+    def _write_loop(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                return
+            try:
+                self._run_batch(batch)
+            except Exception as e:  # The writer must survive anything, otherwise every later write hangs
+                logging.error("write batch error: {!r}".format(e))
+                if self._db.conn.in_transaction:
+                    self._db.conn.rollback()
+                self._db.autocommit = True
+                for future, _, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _run_batch(self, batch: list):
+        db = self._db
+        # Writes of cancelled callers are skipped, the others can not be cancelled any more
+        batch = [op for op in batch if op[0].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        try:
+            # Otherwise releasing the first savepoint would commit it alone. IMMEDIATE: the write lock is taken
+            # (or waited for up to cf.busy_timeout) first, so reads inside see the latest commit of any process
+            db.conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.DatabaseError as e:  # Locked by another process for too long: fail this batch only
+            logging.error("group commit begin error: {}".format(e.args))
+            stats.incr('db busy')
+            for future, _, _ in batch:
+                future.set_exception(e)
+            return
+        db.autocommit = False
+        results = []
+        for future, func, args in batch:
+            db.conn.execute('SAVEPOINT op')
+            try:
+                results.append((future, func(db, *args), None))
+            except Exception as e:
+                db.conn.execute('ROLLBACK TO op')
+                results.append((future, None, e))
+            db.conn.execute('RELEASE op')
+        db.autocommit = True
+
+        try:
+            with stats.timer('db commit'):
+                db.conn.commit()
+            stats.incr('db commits')
+            stats.incr('db committed ops', len(batch))
         except sqlite3.DatabaseError as e:
-            logging.error("set_balance error: {}".format(e.args))
-            return {}
+            logging.error("group commit error: {}".format(e.args))
+            db.conn.rollback()
+            results = [(future, None, e) for future, _, _ in results]
 
-        self.conn.commit()
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    async def migrate(self) -> int:
+        return await self._write(DataBase.migrate)
+
+    async def get_player(self, nickname: str = '', id_: int = 0) -> dict:
+        return await self._read(DataBase.get_player, nickname, id_)
+
+    async def create_player(self, nickname: str, credits_: int = cf.default_credits) -> dict:
+        return await self._write(DataBase.create_player, nickname, credits_)
+
+    async def buy_item(self, player_id_: int, item_id_: int, price: int) -> dict:
+        return await self._write(DataBase.buy_item, player_id_, item_id_, price)
+
+    async def sell_item(self, player_id_: int, item_id_: int, price: int) -> dict:
+        return await self._write(DataBase.sell_item, player_id_, item_id_, price)
+
+    async def get_catalog(self) -> list:
+        return await self._read(DataBase.get_catalog)
+
+    async def get_player_item_counts(self, player_id_: int) -> dict:
+        return await self._read(DataBase.get_player_item_counts, player_id_)
+
+    async def get_player_state(self, player_id_: int) -> dict:
+        # On the writer: ordered with the writes, so a subscriber sees every change once, in the state or as an event
+        return await self._write(DataBase.get_player_state, player_id_)
+
+    async def get_credits(self, id_: int) -> dict:
+        return await self._read(DataBase.get_credits, id_)
+
+    async def get_leaderboard(self) -> dict:
+        return await self._read(DataBase.get_leaderboard)
+
+    async def apply(self, ops: list) -> int:
+        return await self._write(DataBase.apply, ops)
+
+    async def change_credits(self, player_id_: int, delta: int, stake: int = 0, floor: int = 0,
+                             reason: str = 'credits') -> dict:
+        return await self._write(DataBase.change_credits, player_id_, delta, stake, floor, reason)
+
+    async def snapshot(self) -> int:
+        return await self._write(DataBase.snapshot)
+
+    async def get_history(self, player_id_: int, limit: int = 20) -> dict:
+        return await self._read(DataBase.get_history, player_id_, limit)
+
+
+class ShardedDataBase:
+    """
+    Players spread over several SQLite files, each served by its own AsyncDataBase
+    (writer thread, readers, database lock), so writes to different shards run in parallel.
+    A new player is placed by the hash of the nickname and gets an id congruent to the shard number,
+    requests with a player id are routed by id % shards. The items catalog is replicated to every shard.
+    Same interface as AsyncDataBase.
+    """
+
+    def __init__(self, base_name: str = cf.base_name, shards: int = cf.shards, readers: int = cf.db_readers,
+                 ledger: bool = cf.ledger):
+        self.shards = [AsyncDataBase(name, readers, ledger, n, shards)
+                       for n, name in enumerate(shard_names(base_name, shards))]
+
+    def _by_id(self, player_id: int) -> AsyncDataBase:
+        if not isinstance(player_id, int):
+            return self.shards[0]  # Not a valid id, finds nothing there like anywhere else
+        return self.shards[player_id % len(self.shards)]
+
+    def _by_nickname(self, nickname: str) -> AsyncDataBase:
+        return self.shards[nickname_shard(nickname, len(self.shards))]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    async def migrate(self) -> int:
+        return min(await asyncio.gather(*(shard.migrate() for shard in self.shards)))
+
+    async def get_player(self, nickname: str = '', id_: int = 0) -> dict:
+        if id_:
+            return await self._by_id(id_).get_player(id_=id_)
+        if nickname:
+            return await self._by_nickname(nickname).get_player(nickname)
+        return {}
+
+    async def create_player(self, nickname: str, credits_: int = cf.default_credits) -> dict:
+        return await self._by_nickname(nickname).create_player(nickname, credits_)
+
+    async def buy_item(self, player_id_: int, item_id_: int, price: int) -> dict:
+        return await self._by_id(player_id_).buy_item(player_id_, item_id_, price)
+
+    async def sell_item(self, player_id_: int, item_id_: int, price: int) -> dict:
+        return await self._by_id(player_id_).sell_item(player_id_, item_id_, price)
+
+    async def get_catalog(self) -> list:
+        return await self.shards[0].get_catalog()
+
+    async def get_player_item_counts(self, player_id_: int) -> dict:
+        return await self._by_id(player_id_).get_player_item_counts(player_id_)
+
+    async def get_player_state(self, player_id_: int) -> dict:
+        return await self._by_id(player_id_).get_player_state(player_id_)
+
+    async def get_credits(self, id_: int) -> dict:
+        return await self._by_id(id_).get_credits(id_)
+
+    async def get_leaderboard(self) -> dict:
+        result = {'players': [], 'items': {}}
+        for part in await asyncio.gather(*(shard.get_leaderboard() for shard in self.shards)):
+            result['players'].extend(part['players'])
+            for item_id, owned in part['items'].items():
+                result['items'][item_id] = result['items'].get(item_id, 0) + owned
+        return result
+
+    async def apply(self, ops: list) -> int:
+        by_shard = {}
+        for op in ops:
+            by_shard.setdefault(self._by_id(op[1]), []).append(op)
+        return sum(await asyncio.gather(*(shard.apply(o) for shard, o in by_shard.items())))
+
+    async def change_credits(self, player_id_: int, delta: int, stake: int = 0, floor: int = 0,
+                             reason: str = 'credits') -> dict:
+        return await self._by_id(player_id_).change_credits(player_id_, delta, stake, floor, reason)
+
+    async def snapshot(self) -> int:
+        return sum(await asyncio.gather(*(shard.snapshot() for shard in self.shards)))
+
+    async def get_history(self, player_id_: int, limit: int = 20) -> dict:
+        return await self._by_id(player_id_).get_history(player_id_, limit)
+
+
+class Catalog:
+    """
+    In-memory copy of the static items table: O(1) price lookup by id
+    and a pre-serialized answer with the whole catalog.
+    Call GameServer.reload_catalog() after the items table is changed.
+    """
+
+    def __init__(self, items: list = ()):
+        self._items = {}
+        self._ids = []       # Sorted ids, for pagination
+        self._payloads = {}  # Codec name -> encoded frame
+        self.load(items)
+
+    def load(self, items: list):
+        self._items = {item['id']: item for item in sorted(items, key=lambda i: i['id'])}
+        self._ids = list(self._items)
+        self.invalidate()
+
+    def invalidate(self):
+        """ Drop pre-serialized payloads, they are rebuilt on the next request """
+        self._payloads = {}
+
+    def item(self, item_id: int):
+        """ The item or None if there is no such item """
+        return self._items.get(item_id)
+
+    def price(self, item_id: int):
+        """ Price of the item or None if there is no such item """
+        item = self._items.get(item_id)
+        return item['price'] if item else None
+
+    def items(self, ids=None) -> list:
+        """ Items with the given ids or the whole catalog """
+        if ids is None:
+            return list(self._items.values())
+        return [item for id_, item in self._items.items() if id_ in ids]
+
+    def page(self, after_id: int = 0, limit: int = None, include=None) -> tuple:
+        """
+        Items with id > after_id in id order, at most limit (None - all), only those with ids in include
+        (None - any). Returns (items, id to continue after or None at the end)
+        """
+        if include is None:
+            start = bisect.bisect_right(self._ids, after_id)
+            ids = (self._ids[idx] for idx in range(start, len(self._ids)))
+        else:
+            ids = sorted(id_ for id_ in include if id_ > after_id and id_ in self._items)
+        result = []
+        for id_ in ids:
+            if limit is not None and len(result) == limit:
+                return result, result[-1]['id']
+            result.append(self._items[id_])
+        return result, None
+
+    def payload(self, codec: cf.Codec = cf.default_codec) -> bytes:
+        """ Encoded answer {'items': [...]} with the whole catalog """
+        payload = self._payloads.get(codec.name)
+        if payload is None:
+            payload = self._payloads[codec.name] = cf.encode({'items': self.items()}, codec)
+        return payload
+
+
+class ResponseCache:
+    """
+    LRU cache of encoded answers about players: (player id, key) -> frame, e.g. the inventory between purchases.
+    Every write of a player must call invalidate(). An answer read while a write was running could be stale,
+    so a reader takes token() before reading and put() drops the answer if the player was invalidated since.
+    Only for a single server process: workers of Supervisor would not see each other's invalidations.
+    """
+
+    def __init__(self, size: int = cf.response_cache_size):
+        self.size = size
+        self._frames = collections.OrderedDict()  # Least recently used first
+        self._keys = {}         # Player id -> keys of the cached frames
+        self._generation = 0    # Count of invalidations
+        self._invalidated = {}  # Player id -> generation of the last invalidation
+        self._floor = 0         # Generation of invalidations forgotten to bound _invalidated
+
+    def token(self) -> int:
+        return self._generation
+
+    def get(self, player_id: int, key):
+        frame = self._frames.get((player_id, key))
+        if frame is not None:
+            self._frames.move_to_end((player_id, key))
+            stats.incr('response cache hits')
+        else:
+            stats.incr('response cache misses')
+        return frame
+
+    def put(self, player_id: int, key, frame: bytes, token: int):
+        if not self.size or self._invalidated.get(player_id, self._floor) > token:
+            return
+        self._frames[player_id, key] = frame
+        self._keys.setdefault(player_id, set()).add(key)
+        while len(self._frames) > self.size:
+            (old_player, old_key), _ = self._frames.popitem(last=False)
+            keys = self._keys[old_player]
+            keys.discard(old_key)
+            if not keys:
+                del self._keys[old_player]
+
+    def invalidate(self, player_id: int):
+        self._generation += 1
+        self._invalidated[player_id] = self._generation
+        if len(self._invalidated) > self.size:
+            self._invalidated = {}
+            self._floor = self._generation  # Readers which started before are treated as invalidated
+        for key in self._keys.pop(player_id, ()):
+            del self._frames[player_id, key]
+
+    def clear(self):
+        """ Drop all answers, e.g. after the catalog is reloaded """
+        self._frames.clear()
+        self._keys.clear()
+        self._generation += 1
+        self._invalidated = {}
+        self._floor = self._generation
+
+
+class PlayerState:
+    """ Cached state of a logged-in player """
+    __slots__ = ('credits', 'items', 'pending', 'sessions')
+
+    def __init__(self, credits_: int, items: dict):
+        self.credits = credits_
+        self.items = items      # Item id -> quantity, only owned items
+        self.pending = []       # Journal of writes not flushed to the database yet
+        self.sessions = 0       # Connections logged in as this player
+
+
+class PlayerCache:
+    """
+    Write-behind cache of logged-in players. Credits and inventory are served from memory,
+    writes change memory at once and are journaled; the journal is flushed to the database
+    in one batch every cf.write_behind_interval seconds, at the last logout of the player and at shutdown.
+    A crash loses at most the writes of the last interval.
+    Only for a single server process: workers of Supervisor would not see each other's changes.
+    """
+
+    def __init__(self, db: AsyncDataBase, enabled: bool = cf.write_behind):
+        self.db = db
+        self.enabled = enabled
+        self._players = {}
+        self._flushing = asyncio.Lock()
+
+    def get(self, player_id: int):
+        """ PlayerState if the player is cached, else None """
+        return self._players.get(player_id)
+
+    async def acquire(self, player_id: int):
+        """ Cache the player for one more session """
+        if not self.enabled:
+            return
+        state = self._players.get(player_id)
+        if state is None:
+            result = await self.db.get_player_state(player_id)  # Credits and items of the same moment
+            state = PlayerState(result['credits'], dict(map(tuple, result['items'])))
+            state = self._players.setdefault(player_id, state)  # Lost a race - use the winner
+        state.sessions += 1
+
+    async def release(self, player_id: int):
+        """ End of a session, the player is flushed and evicted after the last one """
+        state = self._players.get(player_id)
+        if state is None:
+            return
+        state.sessions -= 1
+        if not state.sessions:
+            await self.flush()
+            if not state.sessions:  # Nobody logged in again while flushing
+                self._players.pop(player_id, None)
+
+    def buy_item(self, state: PlayerState, player_id: int, item_id: int, price: int) -> dict:
+        if state.credits < price:
+            return {'status': 'failed'}
+        state.credits -= price
+        state.items[item_id] = state.items.get(item_id, 0) + 1
+        state.pending.append(('buy_item', player_id, (item_id, price)))
+        return {'status': 'success', 'credits': state.credits, 'delta': -price, 'quantity': state.items[item_id]}
+
+    def sell_item(self, state: PlayerState, player_id: int, item_id: int, price: int) -> dict:
+        quantity = state.items.get(item_id)
+        if not quantity:
+            return {'status': 'failed'}
+        state.credits += price
+        if quantity > 1:
+            state.items[item_id] = quantity - 1
+        else:
+            del state.items[item_id]
+        state.pending.append(('sell_item', player_id, (item_id, price)))
+        return {'status': 'success', 'credits': state.credits, 'delta': price, 'quantity': quantity - 1}
+
+    def change_credits(self, state: PlayerState, player_id: int, delta: int, stake: int = 0, floor: int = 0,
+                       reason: str = 'credits') -> dict:
+        if state.credits < stake:
+            return {'status': 'failed'}
+        balance, state.credits = state.credits, max(state.credits + delta, floor)
+        state.pending.append(('change_credits', player_id, (delta, stake, floor, reason)))
+        return {'status': 'success', 'credits': state.credits, 'delta': state.credits - balance}
+
+    async def flush(self):
+        """ Write journaled changes of all players in one database transaction """
+        async with self._flushing:
+            ops = []
+            for state in self._players.values():
+                ops.extend(state.pending)
+                state.pending = []
+            if not ops:
+                return
+            with stats.timer('cache flush'):
+                failed = await self.db.apply(ops)
+            stats.incr('cache flushed ops', len(ops))
+            if failed:
+                logging.error("flush: {} of {} operations failed".format(failed, len(ops)))
+
+    async def run(self):
+        """ Periodic flush """
+        while True:
+            await asyncio.sleep(cf.write_behind_interval)
+            await self.flush()
+
+
+class TokenBucket:
+    """ Rate limit: rate requests per second on average, up to burst at once """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, cost: int = 1) -> float:
+        """ Spend cost tokens, returns seconds to wait before the request may run (0.0 - at once) """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - cost
+        self.updated = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Session:
+    """ Connection of a client, registered in GameServer.sessions while it is served """
+    __slots__ = ('reader', 'writer', 'codec', 'requests', 'receiver', 'bucket', 'last_active', 'stopping',
+                 'player_id', 'token', 'subscribed', 'admin')
+
+    def __init__(self, reader, writer, requests: asyncio.Queue):
+        self.reader = reader
+        self.writer = writer
+        self.codec = cf.default_codec
+        self.requests = requests
+        self.receiver = None    # Task reading the requests into the queue
+        self.bucket = TokenBucket(cf.rate_limit, cf.rate_burst) if cf.rate_limit else None
+        self.last_active = time.monotonic()
+        self.stopping = False
+        self.player_id = None    # Player logged in on this connection
+        self.token = None        # Session token given to the client at login
+        self.subscribed = False  # Changes of the player are pushed to this connection
+        addr = writer.get_extra_info('peername')
+        self.admin = isinstance(addr, tuple) and addr[0] in cf.admin_hosts  # May run admin commands
+
+    def notify(self, event: dict):
+        """ Send an event message, {'event': name, ...}, between the answers """
+        if not self.writer.is_closing():
+            self.writer.write(cf.encode(event, self.codec))
+
+    def stop(self):
+        """ Graceful close: nothing more is read from the socket, the requests already received are still answered """
+        self.stopping = True
+        self.writer.transport.pause_reading()
+        # The receiver still takes the frames already buffered, then ends as if the client closed the connection
+        self.reader.feed_eof()
 
 
 class GameServer:
@@ -194,14 +980,44 @@ class GameServer:
         s.start()
     """
 
-    def __init__(self, host: str = cf.host, port: int = cf.port):
+    def __init__(self, host: str = cf.host, port: int = cf.port, reuse_port: bool = False,
+                 base_name: str = cf.base_name, write_behind: bool = cf.write_behind, ledger: bool = cf.ledger,
+                 shards: int = cf.shards, response_cache: int = cf.response_cache_size):
         self.host = host
         self.port = port
-        self.db = DataBase()
+        self.reuse_port = reuse_port  # Several worker processes listen on the same port
+        self.ledger = ledger          # Credit changes are appended to the ledger, balances are snapshotted
+        if shards > 1:
+            self.db = ShardedDataBase(base_name, shards, ledger=ledger)
+        else:
+            self.db = AsyncDataBase(base_name, ledger=ledger)
+        self.catalog = Catalog()
+        self.responses = ResponseCache(response_cache)
+        self.players = PlayerCache(self.db, write_behind)
+        self.leaderboard = Leaderboard()
+        self.sessions = set()   # Connections being served
+        self.tokens = {}        # Session token -> Session of the logged-in connection
+        self.subscribers = {}   # Player id -> set of Sessions subscribed to the changes of the player
+        self._tasks = set()     # Handlers of all connections, including those waiting for admission
+        self._admission = None  # Semaphore of cf.max_connections, created with the event loop
+        self._draining = False
+        self.supervisor = None  # Pid of the Supervisor which forwards catalog reloads to all its workers
 
     def start(self):
         loop = asyncio.get_event_loop()
-        coro = asyncio.start_server(self.handle_request, self.host, self.port, loop=loop)
+        try:
+            loop.add_signal_handler(signal.SIGTERM, loop.stop)  # Graceful stop requested by Supervisor
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self.reload_catalog()))
+        except (NotImplementedError, RuntimeError):  # Windows or not the main thread
+            pass
+        loop.run_until_complete(self.db.migrate())
+        # Recovery: fold the ledger tail left by a crash, also required before running without the ledger
+        loop.run_until_complete(self.db.snapshot())
+        loop.run_until_complete(self.reload_catalog())
+        loop.run_until_complete(self.load_leaderboard())
+        self._admission = asyncio.Semaphore(cf.max_connections)
+        coro = asyncio.start_server(self.handle_request, self.host, self.port,
+                                    reuse_port=self.reuse_port or None)
         try:
             server = loop.run_until_complete(coro)
         except OSError as e:
@@ -209,6 +1025,12 @@ class GameServer:
             logging.error("OSError: {}".format(e.args))
             return
         print('Start server on {}'.format(server.sockets[0].getsockname()))
+        dumper = asyncio.ensure_future(self._dump_stats()) if cf.stats_file else None
+        flusher = asyncio.ensure_future(self.players.run()) if self.players.enabled else None
+        snapshotter = asyncio.ensure_future(self._snapshot()) if self.ledger else None
+        reaper = asyncio.ensure_future(self._reap_idle()) if cf.idle_timeout else None
+        # Changes made by the other workers are not seen here, so a worker reloads its leaderboard
+        ranker = asyncio.ensure_future(self._reload_leaderboard()) if self.reuse_port else None
         # Serve requests until Ctrl+C is pressed
         try:
             loop.run_forever()
@@ -216,134 +1038,632 @@ class GameServer:
             print('KeyboardInterrupt. Exit')
             pass
 
-        # TODO При одновременном подключении нескольких клиентов остальные на остановку сервера никак не отреагировали.
-        # Но при попытке отправки какого-либо запроса клиенты падали на необработанном исключении.
-        #
-        # Решение: у сервера должен быть список (например, в виде таблицы БД) залогинившихся в текущий момент
-        # пользователей (в данном случае можно пройтись по запущенным сопрограммам).
-        # При остановке сервера он должен рассылать этому списку уведомления о своей остановке.
-        # Ну и соответственно, сделать обработку этого уведомления на клиенте.
-
         # Close the server
+        try:
+            loop.add_signal_handler(signal.SIGTERM, lambda: None)  # A repeated SIGTERM must not stop the cleanup
+        except (NotImplementedError, RuntimeError):
+            pass
+        server.close()  # No new connections
+        loop.run_until_complete(self.drain())
+        if reaper:
+            reaper.cancel()
+        if dumper:
+            dumper.cancel()
+        if flusher:
+            flusher.cancel()
+        if snapshotter:
+            snapshotter.cancel()
+        if ranker:
+            ranker.cancel()
+        loop.run_until_complete(self.players.flush())
+        if self.ledger:
+            loop.run_until_complete(self.db.snapshot())
         self.db.close()
-        server.close()
         loop.run_until_complete(server.wait_closed())
         loop.close()
 
     async def handle_request(self, reader, writer):
         """
         API
-        1. request: {'login': nickname}
-            answer: dict with player's properties
+        1. request: {'login': nickname, 'codecs': [name, ...]}
+            answer: dict with player's properties, 'token' of the session and 'codec': the first supported
+            of the offered codecs. Login messages are JSON, all following messages use the chosen codec
+            ('codecs' is optional).
+            Requests 2-13 need a login on the same connection and are made for its player: 'player_id' and
+            'token' may be omitted, given ones must match the session, otherwise the answer is
+            {'status': 'failed'}. The session ends at logout or when the connection closes
         2. request: {'get': items, 'player_id': id}
-            answer: dict with items which can be bought
+            answer: dict with items which can be bought: the whole catalog, owned items too (the inventory
+            stacks units of an item)
         3. request: {'get': inventory, 'player_id': id}
-            answer: dict with user's items
+            answer: dict with user's items, each with its 'quantity'
+            Listings 2, 3 may be paginated: {..., 'limit': n, 'after_id': id} answers one page in id order
+            with 'next': after_id of the next page or None after the last one.
+            Or streamed: {..., 'stream': True} answers with several messages of up to cf.page_size
+            ('limit') items, every one with 'more': True but the last (in a batch it is answered at once)
         4. request: {'buy': item_id, 'player_id': id}
-            answer: {'status': 'failed' | 'success'}
+            answer: {'status': 'failed' | 'success'}, on success also the new balance 'credits',
+            its change 'delta' and the new 'quantity' of the item
         5. request: {'sell': item_id, 'player_id': id}
-            answer: {'status': 'failed' | 'success'}
+            answer: same as 4, sells one unit of the item
         6. request: {'game': bet, 'player_id': id}
-            answer: {'status': 'failed' | 'success'}
+            answer: {'status': 'failed' | 'success'}, a win also with 'credits' and 'delta'
         7. request: {'logout': nickname}
             No answer, just close connection
+        8. request: {'reload': 'catalog'}
+            answer: {'status': 'success'}, re-reads the items table into the catalog cache; under Supervisor
+            all workers reload. SIGHUP to the server or to the supervisor process does the same.
+            Admin command: only for connections from cf.admin_hosts, for others the answer is {'status': 'failed'}
+        9. request: {'batch': [request, ...]}
+            answer: {'batch': [answer, ...]}, requests 2-8, 10, 11, 13 run in order and answered in one message
+        10. request: {'get': 'stats'}
+            answer: counters and latency histograms of this server process (see stats.py). Admin command as 8
+        11. request: {'get': 'history', 'player_id': id, 'limit': n}
+            answer: {'history': [{'seq', 'delta', 'reason', 'item_id', 'created_at'}, ...]}, newest first,
+            credit changes recorded in ledger mode ('limit' is optional, at most 100)
+        12. request: {'subscribe': True | False}
+            answer: {'status': 'success', 'credits': balance, 'items': [[item_id, quantity], ...]} - the current
+            state, then every change of the player's credits or inventory, made on any connection, is pushed
+            as events (below). False ends the subscription. Not in batches, fails on Supervisor workers
+        13. request: {'get': 'leaderboard', 'player_id': id, 'limit': k}
+            answer: {'players': [{'id', 'nickname', 'credits'}, ...] - the k richest,
+            'items': [{'id', 'name', 'owned'}, ...] - the k items with most units owned by all players,
+            'rank': place of the player by credits (1 - the richest), 'total': count of players}
+            ('limit' is optional, 10 by default, at most cf.max_page). Supervisor workers answer from
+            a copy reloaded every cf.leaderboard_interval seconds
+
+        Every message is a frame: 4-byte big-endian payload length followed by the encoded payload.
+        Requests may be pipelined, answers are sent in the order of requests.
+        The server may send events between answers: {'event': 'shutdown'} - the server is stopping,
+        requests sent before are answered, then the connection is closed.
+        Subscribed connections (12) get {'event': 'credits', 'credits': balance, 'delta': change} and
+        {'event': 'item', 'item_id': id, 'quantity': new quantity (0 - sold out), 'delta': 1 | -1}.
+        Events of the changes included in the answer to 12 are sent before it.
         """
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        if self._admission.locked():
+            stats.incr('connections queued')
         try:
-            addr = writer.get_extra_info('peername')
-            while True:
-                # TODO При обработке запросов от клиента на сервере нет проверки на некорректные аргументы – никак
-                # не обрабатываются случаи, если данные по указанному player_id отсутствуют.
-                #
-                # Решение: проверка валидности данных на стороне сервере обязательна. Проверки на стороне
-                # клиента нужны в основном для того, чтобы не нагружать сервер заведомо неверными запросами. Поэтому
-                # обычно проверки на стороне клиента - поверхностные, на общую корректность. Все остальное на сервере:
-                # можно ли что-то сделать, есть ли такой пользователь, есть ли у него права на это действие и т.д.
-                # Правильным решением будет использование что-то вроде
-                # if not self.valid(request): data = {'status': 'failed'}
+            # Backpressure: connections above cf.max_connections wait here, their requests are not read
+            async with self._admission:
+                if not self._draining:
+                    await self._serve(reader, writer)
+        finally:
+            self._tasks.discard(task)
+            writer.close()
 
+    async def _serve(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        stats.incr('connections total')
+        stats.incr('connections open')
+        codec = cf.default_codec
+        requests = asyncio.Queue(maxsize=cf.max_pipeline)
+        session = Session(reader, writer, requests)
+        receiver = session.receiver = asyncio.ensure_future(self._receive(session))
+        self.sessions.add(session)
+        try:
+            while True:
                 data = None
-                request_b = await reader.read(cf._max_buffer)
-                request = cf.decode(request_b)
+                next_codec = codec
+                request = await requests.get()
+                if request is None or isinstance(request, asyncio.IncompleteReadError):
+                    break
+                if isinstance(request, Exception):
+                    raise request
+                session.last_active = time.monotonic()
+                started = time.perf_counter()
+                request = cf.decode(request, codec)
+                stats.observe('decode', time.perf_counter() - started)
+                if session.bucket:
+                    delay = session.bucket.take(len(request['batch']) if isinstance(request.get('batch'), list) else 1)
+                    if delay:
+                        stats.incr('requests throttled')
+                        await asyncio.sleep(delay)
                 logging.debug('Server received from {}: {}'.format(addr, request))
                 keys_ = request.keys()
+                started = time.perf_counter()
 
                 if 'login' in keys_:
-                    data = self.login(request['login'])
-                    if not data:
-                        data = {'status': 'failed'}
-
-                elif 'get' in keys_:
-                    if request['get'] == 'items':
-                        data = self.get_items(request['player_id'])
-                    elif request['get'] == 'inventory':
-                        data = self.get_player_items(request['player_id'])
-                    elif request['get'] == 'credits':
-                        data = self.get_credits(request['player_id'])
-
-                elif 'buy' in keys_:
-                    data = self.buy_item(request['player_id'], request['buy'])
-
-                elif 'sell' in keys_:
-                    data = self.sell_item(request['player_id'], request['sell'])
-
-                elif 'game' in keys_:
-                    data = self.game(request['player_id'], request['game'])
+                    data = await self.login(request['login'])
+                    if data:
+                        # The player is cached while the connection lives
+                        if data['id'] != session.player_id:
+                            await self.players.acquire(data['id'])
+                            if session.player_id:
+                                await self.players.release(session.player_id)
+                        self._open_session(session, data['id'])
+                        data['token'] = session.token
+                    if data and 'codecs' in keys_:
+                        next_codec = cf.choose_codec(request['codecs'])
+                        data['codec'] = next_codec.name
 
                 elif 'logout' in keys_:
-                    writer.close()
-                    # await writer.wait_closed()
                     logging.debug('Logout {} ({})'.format(request['logout'], addr))
                     break
 
+                elif 'subscribe' in keys_ and self._authorize(session, request):
+                    data = await self.subscribe(session, bool(request['subscribe']))
+
+                elif self._authorize(session, request):
+                    data = await self.dispatch(request, codec)
+
+                # Every request gets exactly one answer, otherwise pipelined answers get out of step
                 if not data:
+                    data = {'status': 'failed'}
+                stats.observe('cmd ' + command_name(request), time.perf_counter() - started)
+
+                # Streamed answer: the parts are sent one by one, so only one part is buffered at a time
+                if isinstance(data, types.GeneratorType):
+                    for part in data:
+                        part = cf.encode(part, codec)
+                        writer.write(part)
+                        stats.incr('bytes out', len(part))
+                        await writer.drain()
                     continue
 
-                writer.write(cf.encode(data))
+                # Pre-serialized answers (bytes) are sent as is
+                if not isinstance(data, bytes):
+                    started = time.perf_counter()
+                    data = cf.encode(data, codec)
+                    stats.observe('encode', time.perf_counter() - started)
+                writer.write(data)
+                stats.incr('bytes out', len(data))
                 logging.debug('Server send to {}: {}'.format(addr, data))
-                await writer.drain()
+                codec = session.codec = next_codec
+                # Answers to pipelined requests are flushed together
+                if requests.empty():
+                    await writer.drain()
 
         except ConnectionResetError as e:
             print('Connection reset by peer')
             logging.error("ConnectionResetError: {}".format(e.args))
-            writer.close()
-            # await writer.wait_closed()
-        except json.decoder.JSONDecodeError as e:
+        except ValueError as e:
             print('Uncorrected format')
-            logging.error("JSONDecodeError: {}".format(e.args))
-            writer.close()
-            # await writer.wait_closed()
+            logging.error("ValueError: {}".format(e.args))
 
         finally:
+            self.sessions.discard(session)
+            stats.incr('connections open', -1)
+            receiver.cancel()
+            self._close_session(session)
+            if session.player_id:
+                await self.players.release(session.player_id)
+            writer.close()
+            # await writer.wait_closed()
             print("Closed connection from {}".format(addr))
 
-    def login(self, nickname: str) -> dict:
-        result = self.db.get_player(nickname=nickname)
+    async def dispatch(self, request: dict, codec: cf.Codec = None):
+        """
+        Run one command (all but login/logout), returns the answer.
+        With codec the answer may be pre-encoded (bytes), without it is always a dict
+        """
+        keys_ = request.keys()
+
+        if 'get' in keys_:
+            if request['get'] in ('items', 'inventory'):
+                after_id, limit = request.get('after_id', 0), request.get('limit')
+                if not isinstance(after_id, int) or not (limit is None or isinstance(limit, int) and limit > 0):
+                    return {'status': 'failed'}
+                if limit is not None:
+                    limit = min(limit, cf.max_page)
+                player_id = request['player_id']
+                if request.get('stream') and codec is not None:
+                    if request['get'] == 'items':
+                        return self.get_items(codec, after_id, limit, stream=True)
+                    return await self.get_player_items(player_id, after_id, limit, stream=True)
+                if request['get'] == 'items':
+                    return self.get_items(codec, after_id, limit)
+                return await self._cached(player_id, ('inventory', after_id, limit), codec,
+                                          lambda: self.get_player_items(player_id, after_id, limit))
+            elif request['get'] == 'credits':
+                player_id = request['player_id']
+                return await self._cached(player_id, ('credits',), codec, lambda: self.get_credits(player_id))
+            elif request['get'] == 'stats':
+                return stats.snapshot()
+            elif request['get'] == 'history':
+                return await self.get_history(request['player_id'], request.get('limit', 20))
+            elif request['get'] == 'leaderboard':
+                return self.get_leaderboard(request['player_id'], request.get('limit', 10))
+
+        elif 'buy' in keys_:
+            return await self.buy_item(request['player_id'], request['buy'])
+
+        elif 'sell' in keys_:
+            return await self.sell_item(request['player_id'], request['sell'])
+
+        elif 'game' in keys_:
+            return await self.game(request['player_id'], request['game'])
+
+        elif 'batch' in keys_:
+            return await self.batch(request['batch'])
+
+        elif 'reload' in keys_:
+            if request['reload'] == 'catalog':
+                if self.supervisor:  # The other workers reload on the signal forwarded by the supervisor
+                    os.kill(self.supervisor, signal.SIGHUP)
+                return await self.reload_catalog()
+
+    def _open_session(self, session: Session, player_id: int):
+        self._close_session(session)
+        session.player_id = player_id
+        session.token = secrets.token_hex(16)
+        self.tokens[session.token] = session
+
+    def _close_session(self, session: Session):
+        self._unsubscribe(session)
+        self.tokens.pop(session.token, None)
+        session.token = None
+
+    async def subscribe(self, session: Session, on: bool = True) -> dict:
+        """ Push the changes of the session's player to the connection, answers with the current state """
+        self._unsubscribe(session)
+        if not on:
+            return {'status': 'success'}
+        if self.reuse_port:
+            return {'status': 'failed'}  # Changes made by the other worker processes would be missed
+        player_id = session.player_id
+        self.subscribers.setdefault(player_id, set()).add(session)
+        session.subscribed = True
+        state = self.players.get(player_id)
+        if state:
+            result = {'credits': state.credits, 'items': sorted(map(list, state.items.items()))}
+        else:
+            result = await self.db.get_player_state(player_id)
+        return dict(result, status='success')
+
+    def _unsubscribe(self, session: Session):
+        if not session.subscribed:
+            return
+        session.subscribed = False
+        sessions = self.subscribers.get(session.player_id, set())
+        sessions.discard(session)
+        if not sessions:
+            self.subscribers.pop(session.player_id, None)
+
+    def _publish(self, player_id: int, result: dict, item_id: int = None, quantity_delta: int = 0):
+        """ Apply the change made by a successful write to the leaderboard, push it to the subscribed connections """
+        if result.get('status') != 'success':
+            return
+        self.leaderboard.set_credits(player_id, result['credits'])
+        if item_id is not None:
+            self.leaderboard.add_owned(item_id, quantity_delta)
+        sessions = self.subscribers.get(player_id)
+        if not sessions:
+            return
+        events = [{'event': 'credits', 'credits': result['credits'], 'delta': result['delta']}]
+        if item_id is not None:
+            events.append({'event': 'item', 'item_id': item_id, 'quantity': result['quantity'],
+                           'delta': quantity_delta})
+        for session in sessions:
+            for event in events:
+                session.notify(event)
+        stats.incr('events pushed', len(sessions) * len(events))
+
+    def _authorize(self, session: Session, request: dict) -> bool:
+        """
+        Check that the request is made for the player logged in on this connection and fill in player_id:
+        O(1) by the session token or the connection, the database is not asked. Admin commands need an admin host
+        """
+        if session.player_id is None:
+            return False
+        if 'token' in request and (not isinstance(request['token'], str) or
+                                   self.tokens.get(request['token']) is not session):
+            return False
+        if request.get('player_id', session.player_id) != session.player_id:
+            return False
+        if not session.admin and ('reload' in request or request.get('get') == 'stats'):
+            return False
+        request['player_id'] = session.player_id
+        batch = request.get('batch')
+        if isinstance(batch, list):
+            return all(self._authorize(session, r) for r in batch if isinstance(r, dict))
+        return True
+
+    async def drain(self):
+        """ Graceful stop: notify the clients, answer the requests already received and close the connections """
+        self._draining = True
+        for session in list(self.sessions):
+            session.notify({'event': 'shutdown'})
+            session.stop()
+        if not self._tasks:
+            return
+        _, pending = await asyncio.wait(list(self._tasks), timeout=cf.shutdown_timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _reap_idle(self):
+        """ Close connections without requests for cf.idle_timeout seconds, e.g. of vanished clients """
+        while True:
+            await asyncio.sleep(cf.idle_timeout / 4)
+            deadline = time.monotonic() - cf.idle_timeout
+            for session in list(self.sessions):
+                if session.last_active < deadline:
+                    stats.incr('connections reaped')
+                    session.writer.close()
+
+    async def _dump_stats(self):
+        """ Write stats snapshot to cf.stats_file every cf.stats_interval seconds """
+        name = cf.stats_file.format(pid=os.getpid())
+        while True:
+            await asyncio.sleep(cf.stats_interval)
+            with open(name, 'w', encoding='utf-8') as f:
+                json.dump(stats.snapshot(), f, indent=2)
+
+    async def _reload_leaderboard(self):
+        while True:
+            await asyncio.sleep(cf.leaderboard_interval)
+            with stats.timer('leaderboard load'):
+                await self.load_leaderboard()
+
+    async def _snapshot(self):
+        """ Fold the ledger into players every cf.snapshot_interval seconds, keeps balance reads short """
+        while True:
+            await asyncio.sleep(cf.snapshot_interval)
+            with stats.timer('ledger snapshot'):
+                await self.db.snapshot()
+
+    async def batch(self, requests: list) -> dict:
+        """ Run commands one after another, answer with the list of their answers in the same order """
+        if not isinstance(requests, list):
+            return {'status': 'failed'}
+        results = []
+        for request in requests:
+            result = None
+            if isinstance(request, dict) and 'batch' not in request:
+                result = await self.dispatch(request)
+            results.append(result or {'status': 'failed'})
+        return {'batch': results}
+
+    @staticmethod
+    async def _receive(session: Session):
+        """ Read length-prefixed frames and queue their payloads, so the client may pipeline requests """
+        reader, requests = session.reader, session.requests
+        while True:
+            try:
+                header = await reader.readexactly(cf.header_size)
+                request = await reader.readexactly(cf.payload_size(header))
+            except (asyncio.IncompleteReadError, ConnectionResetError, ValueError) as e:
+                await requests.put(e)
+                return
+            if session.stopping:
+                session.writer.transport.pause_reading()  # Reading the buffer may have resumed the transport
+            stats.incr('bytes in', cf.header_size + len(request))
+            await requests.put(request)
+
+    async def login(self, nickname: str) -> dict:
+        result = await self.db.get_player(nickname=nickname)
         if not result:
-            return self.db.create_player(nickname=nickname)
+            result = await self.db.create_player(nickname=nickname)
+            if result:
+                self.leaderboard.set_credits(result['id'], result['credits'], result['nickname'])
+            return result
+        state = self.players.get(result['id'])
+        if state:
+            result['credits'] = state.credits
         return result
 
-    def get_items(self, player_id: int) -> dict:
-        result = self.db.get_items(player_id)
+    async def load_leaderboard(self):
+        """ Rebuild the leaderboard from the database, later it is kept current by every change """
+        result = await self.db.get_leaderboard()
+        self.leaderboard.load(result['players'], result['items'])
+
+    async def reload_catalog(self) -> dict:
+        self.catalog.load(await self.db.get_catalog())
+        self.responses.clear()
+        return {'status': 'success'}
+
+    async def _cached(self, player_id: int, key: tuple, codec: cf.Codec, answer):
+        """ Encoded answer from the response cache, else the result of the coroutine function answer(), cached """
+        if codec is None or not self.responses.size or not isinstance(player_id, int):
+            return await answer()
+        key += (codec.name,)
+        frame = self.responses.get(player_id, key)
+        if frame is None:
+            token = self.responses.token()
+            frame = await answer()
+            if isinstance(frame, bytes):  # Already cached elsewhere (whole catalog)
+                return frame
+            frame = cf.encode(frame, codec)
+            self.responses.put(player_id, key, frame, token)
+        return frame
+
+    async def _owned_item_counts(self, player_id: int) -> dict:
+        state = self.players.get(player_id)
+        if state:
+            return state.items
+        return await self.db.get_player_item_counts(player_id)
+
+    def _pages(self, after_id: int, size: int, include=None):
+        """ Catalog pages until the end: (items, more) """
+        while True:
+            items, after_id = self.catalog.page(after_id, size, include)
+            yield items, after_id is not None
+            if after_id is None:
+                return
+
+    def get_items(self, codec: cf.Codec = None, after_id: int = 0, limit: int = None, stream: bool = False):
+        """ The whole catalog, owned items too: answer, pre-encoded answer or with stream a generator of answers """
+        if stream:
+            return ({'items': items, 'more': more} for items, more in self._pages(after_id, limit or cf.page_size))
+        if limit is not None or after_id:
+            items, next_id = self.catalog.page(after_id, limit)
+            return {'items': items, 'next': next_id}
+        return self.catalog.payload(codec) if codec else {'items': self.catalog.items()}
+
+    async def get_player_items(self, player_id: int, after_id: int = 0, limit: int = None, stream: bool = False):
+        owned = dict(await self._owned_item_counts(player_id))  # Copy: the cached one may change while streaming
+        result = await self.get_credits(player_id)
+        if stream:
+            return (dict(result, items=[dict(item, quantity=owned[item['id']]) for item in items], more=more)
+                    for items, more in self._pages(after_id, limit or cf.page_size, include=owned))
+        items, next_id = self.catalog.page(after_id, limit, include=owned)
+        result['items'] = [dict(item, quantity=owned[item['id']]) for item in items]
+        if limit is not None or after_id:
+            result['next'] = next_id
         return result
 
-    def get_player_items(self, player_id: int) -> dict:
-        return self.db.get_player_items(player_id)
+    async def get_credits(self, player_id: int) -> dict:
+        state = self.players.get(player_id)
+        if state:
+            return {'credits': state.credits}
+        return await self.db.get_credits(player_id)
 
-    def get_credits(self, player_id: int) -> dict:
-        return self.db.get_credits(player_id)
+    def get_leaderboard(self, player_id: int, limit: int) -> dict:
+        if not isinstance(limit, int) or limit <= 0:
+            return {'status': 'failed'}
+        limit = min(limit, cf.max_page)
+        items = []
+        for item_id, owned in self.leaderboard.top_items(limit):
+            item = self.catalog.item(item_id)
+            items.append({'id': item_id, 'name': item['name'] if item else '', 'owned': owned})
+        return {'players': self.leaderboard.top_players(limit), 'items': items,
+                'rank': self.leaderboard.rank(player_id), 'total': len(self.leaderboard)}
 
-    def buy_item(self, player_id: int, item_id: int) -> dict:
-        return self.db.buy_item(player_id, item_id)
+    async def get_history(self, player_id: int, limit: int) -> dict:
+        if not isinstance(limit, int) or limit <= 0:
+            return {'status': 'failed'}
+        return await self.db.get_history(player_id, min(limit, 100))
 
-    def sell_item(self, player_id: int, item_id: int) -> dict:
-        return self.db.sell_item(player_id, item_id)
+    async def buy_item(self, player_id: int, item_id: int) -> dict:
+        if not isinstance(item_id, int):
+            return {'status': 'failed'}
+        price = self.catalog.price(item_id)
+        if price is None:
+            return {'status': 'failed'}
+        state = self.players.get(player_id)
+        try:
+            if state:
+                result = self.players.buy_item(state, player_id, item_id, price)
+            else:
+                result = await self.db.buy_item(player_id, item_id, price)
+        finally:
+            self.responses.invalidate(player_id)  # After the commit, so overlapping reads are not cached
+        self._publish(player_id, result, item_id, 1)
+        return result
+
+    async def sell_item(self, player_id: int, item_id: int) -> dict:
+        if not isinstance(item_id, int):
+            return {'status': 'failed'}
+        price = self.catalog.price(item_id)
+        if price is None:
+            return {'status': 'failed'}
+        state = self.players.get(player_id)
+        try:
+            if state:
+                result = self.players.sell_item(state, player_id, item_id, price)
+            else:
+                result = await self.db.sell_item(player_id, item_id, price)
+        finally:
+            self.responses.invalidate(player_id)
+        self._publish(player_id, result, item_id, -1)
+        return result
+
+    async def _change_credits(self, player_id: int, delta: int, stake: int = 0, floor: int = 0,
+                              reason: str = 'credits') -> dict:
+        state = self.players.get(player_id)
+        try:
+            if state:
+                result = self.players.change_credits(state, player_id, delta, stake, floor, reason)
+            else:
+                result = await self.db.change_credits(player_id, delta, stake, floor, reason)
+        finally:
+            self.responses.invalidate(player_id)
+        self._publish(player_id, result)
+        return result
+
+    async def game(self, player_id: int, bet: int) -> dict:
+        if not isinstance(bet, int) or not 0 < bet <= _MAX_INTEGER:
+            return {'status': 'failed'}
 
-    def game(self, player_id: int, bet: int) -> dict:
-        cr = self.db.get_credits(player_id)['credits']
         if random.randint(1, 100) < cf.pers_win:
-            self.db.set_balance(player_id, cr + bet)
-            return {'status': 'success'}
+            result = await self._change_credits(player_id, bet, stake=bet, reason='game')
+            return result
 
-        result = max(cr - bet, 50)
-        self.db.set_balance(player_id, result)
+        # Loss never leaves the player with less than 50 credits
+        await self._change_credits(player_id, -bet, stake=bet, floor=50, reason='game')
         return {'status': 'failed'}
+
+
+def _migrate(base_name: str, shards: int = cf.shards):
+    for name in shard_names(base_name, shards):
+        db = DataBase(name)
+        db.migrate()
+        db.close()
+
+
+def _run_worker(host: str, port: int, base_name: str, shards: int):
+    # Caches are per process: with write-behind workers would overwrite each other's changes,
+    # with the response cache they would serve answers changed by other workers
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)  # Inherited from the supervisor until the server handles it
+    server = GameServer(host, port, reuse_port=True, base_name=base_name, write_behind=False, shards=shards,
+                        response_cache=0)
+    server.supervisor = os.getppid()
+    server.start()
+
+
+class Supervisor:
+    """
+    Runs GameServer in several worker processes which share the port via SO_REUSEPORT,
+    each with its own connections to the WAL-mode database. Restarts workers which died,
+    stops all of them gracefully on Ctrl+C or SIGTERM, forwards SIGHUP (reload the catalog) to all of them.
+    usage:
+        s = server.Supervisor(workers=4)
+        s.start()
+    """
+
+    def __init__(self, workers: int, host: str = cf.host, port: int = cf.port, base_name: str = cf.base_name,
+                 shards: int = cf.shards):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.base_name = base_name
+        self.shards = shards
+        self._running = False
+        self._processes = []
+
+    def _spawn(self) -> multiprocessing.Process:
+        p = multiprocessing.Process(target=_run_worker, args=(self.host, self.port, self.base_name, self.shards),
+                                    daemon=True)
+        p.start()
+        return p
+
+    def _stop(self, *args):
+        self._running = False
+
+    def _reload(self, *args):
+        """ SIGHUP: every worker reloads the catalog """
+        for p in self._processes:
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGHUP)
+
+    def start(self):
+        # Migrate once here, otherwise workers would race to apply the same migration.
+        # In a child process: SQLite state must not be inherited by the forked workers
+        p = multiprocessing.Process(target=_migrate, args=(self.base_name, self.shards))
+        p.start()
+        p.join()
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGHUP, self._reload)
+        self._running = True
+        self._processes = [self._spawn() for _ in range(self.workers)]
+        print('Supervisor started {} workers'.format(self.workers))
+        try:
+            while self._running:
+                for idx, p in enumerate(self._processes):
+                    if not p.is_alive():
+                        print('Worker {} exited with code {}, restart'.format(p.pid, p.exitcode))
+                        self._processes[idx] = self._spawn()
+                time.sleep(cf.supervisor_interval)
+        except KeyboardInterrupt:
+            print('KeyboardInterrupt. Exit')
+
+        for p in self._processes:
+            if p.is_alive():
+                p.terminate()  # SIGTERM: worker finishes and closes its database
+        for p in self._processes:
+            p.join(cf.shutdown_timeout)
+            if p.is_alive():
+                p.kill()
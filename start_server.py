@@ -1,7 +1,16 @@
 #!/usr/bin/python3
 
+import argparse
 import server
 
 if __name__ == '__main__':
-    s = server.GameServer()
+    parser = argparse.ArgumentParser(description='Run game server')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of server processes sharing the port (SO_REUSEPORT)')
+    args = parser.parse_args()
+
+    if args.workers > 1:
+        s = server.Supervisor(args.workers)
+    else:
+        s = server.GameServer()
     s.start()
@@ -0,0 +1,94 @@
+""" Low-overhead runtime statistics: counters and latency histograms shared by server threads """
+
+import bisect
+import contextlib
+import threading
+import time
+
+# Upper bounds of histogram buckets, seconds: 1 us, 2 us, 4 us ... ~67 s, the last bucket is unbounded
+_bounds = [1e-6 * 2 ** i for i in range(27)]
+
+
+def command_name(request: dict) -> str:
+    """ Name of the command for reports: 'get items', 'buy', 'batch', ... """
+    if 'get' in request:
+        return 'get {}'.format(request['get'])
+    return next(iter(request), '?')
+
+
+class Histogram:
+    """ Latency histogram with logarithmic buckets, percentiles are bucket upper bounds """
+
+    def __init__(self):
+        self.counts = [0] * (len(_bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        self.counts[bisect.bisect_left(_bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, q: float) -> float:
+        rank = self.count * q / 100
+        seen = 0
+        for idx, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(_bounds[idx], self.max) if idx < len(_bounds) else self.max
+        return 0.0
+
+    def snapshot(self) -> dict:
+        return {'count': self.count,
+                'mean_ms': self.total / self.count * 1000 if self.count else 0.0,
+                'p50_ms': self.percentile(50) * 1000,
+                'p95_ms': self.percentile(95) * 1000,
+                'p99_ms': self.percentile(99) * 1000,
+                'max_ms': self.max * 1000}
+
+
+class Stats:
+    """
+    Named counters and histograms. Safe to update from the event loop and from DB threads.
+    usage:
+        stats.incr('bytes_in', 100)
+        with stats.timer('db.commit'):
+            ...
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self.started = time.time()
+
+    def incr(self, name: str, n: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            h = self._histograms.get(name)
+            if h is None:
+                h = self._histograms[name] = Histogram()
+            h.record(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'uptime': time.time() - self.started,
+                    'counters': dict(self._counters),
+                    'latency': {name: h.snapshot() for name, h in sorted(self._histograms.items())}}
+
+
+stats = Stats()     # Statistics of this process
@@ -0,0 +1,74 @@
+""" Round-trip and wire format tests of binpack, run: python -m unittest test_binpack """
+
+import unittest
+import binpack
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+SAMPLES = [
+    None, True, False,
+    0, 1, 127, 128, 255, 256, 65535, 65536, 2 ** 32 - 1, 2 ** 32, 2 ** 64 - 1,
+    -1, -32, -33, -128, -129, -32768, -32769, -2 ** 31, -2 ** 31 - 1, -2 ** 63,
+    0.0, 1.5, -2.25, 1e300,
+    '', 'a', 'x' * 31, 'x' * 32, 'x' * 255, 'x' * 256, 'x' * 65536, 'galeon', 'тедди',
+    b'', b'\x00\xff', b'y' * 256, b'y' * 65536,
+    [], [1, 'two', None], list(range(15)), list(range(16)), list(range(65536)),
+    {}, {'id': 1, 'name': 'sword', 'price': 40}, {i: i for i in range(16)}, {str(i): i for i in range(65536)},
+    {'items': [{'id': 1, 'name': 'galeon', 'price': 400, 'quantity': 2}], 'next': None, 'more': True},
+]
+
+
+class RoundTripTest(unittest.TestCase):
+    def test_samples(self):
+        for value in SAMPLES:
+            self.assertEqual(binpack.unpackb(binpack.packb(value)), value)
+
+    def test_tuple_is_array(self):
+        self.assertEqual(binpack.unpackb(binpack.packb((1, 2))), [1, 2])
+
+
+class WireFormatTest(unittest.TestCase):
+    """ Encodings from the MessagePack specification """
+
+    def test_encodings(self):
+        cases = [
+            (None, b'\xc0'), (False, b'\xc2'), (True, b'\xc3'),
+            (5, b'\x05'), (-1, b'\xff'), (-32, b'\xe0'), (128, b'\xcc\x80'), (256, b'\xcd\x01\x00'),
+            (-33, b'\xd0\xdf'), (2 ** 32, b'\xcf\x00\x00\x00\x01\x00\x00\x00\x00'),
+            (1.5, b'\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00'),
+            ('abc', b'\xa3abc'), ('x' * 32, b'\xd9\x20' + b'x' * 32), (b'\x01', b'\xc4\x01\x01'),
+            ([1, 2], b'\x92\x01\x02'), ({'a': 1}, b'\x81\xa1a\x01'),
+        ]
+        for value, packed in cases:
+            self.assertEqual(binpack.packb(value), packed)
+            self.assertEqual(binpack.unpackb(packed), value)
+
+    def test_float32(self):
+        self.assertEqual(binpack.unpackb(b'\xca\x3f\xc0\x00\x00'), 1.5)
+
+    @unittest.skipIf(msgpack is None, 'msgpack is not installed')
+    def test_compatible_with_msgpack(self):
+        for value in SAMPLES:
+            self.assertEqual(binpack.packb(value), msgpack.packb(value, use_bin_type=True))
+            self.assertEqual(msgpack.unpackb(binpack.packb(value), raw=False, strict_map_key=False), value)
+
+
+class ErrorTest(unittest.TestCase):
+    def test_malformed(self):
+        for packed in (b'', b'\xcd\x01', b'\x92\x01', b'\xa3ab', b'\xc1', b'\x01\x02'):
+            with self.assertRaises(ValueError):
+                binpack.unpackb(packed)
+
+    def test_unsupported(self):
+        with self.assertRaises(TypeError):
+            binpack.packb({1, 2})
+        with self.assertRaises(OverflowError):
+            binpack.packb(2 ** 64)
+
+
+if __name__ == '__main__':
+    unittest.main()
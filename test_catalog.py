@@ -0,0 +1,64 @@
+""" Tests of the catalog cache and its pagination, run: python -m unittest test_catalog """
+
+import unittest
+import projectconf as cf
+from server import Catalog
+
+ITEMS = [{'id': id_, 'name': 'item {}'.format(id_), 'price': id_ * 10} for id_ in (7, 1, 3, 5, 9)]
+
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        self.catalog = Catalog(ITEMS)
+
+    def ids(self, items: list) -> list:
+        return [item['id'] for item in items]
+
+    def test_lookup(self):
+        self.assertEqual(self.catalog.price(3), 30)
+        self.assertIsNone(self.catalog.price(2))
+        self.assertIsNone(self.catalog.item(2))
+        self.assertEqual(self.ids(self.catalog.items()), [1, 3, 5, 7, 9])
+        self.assertEqual(self.ids(self.catalog.items({9, 1})), [1, 9])
+
+    def test_pages(self):
+        items, next_id = self.catalog.page(0, 2)
+        self.assertEqual((self.ids(items), next_id), ([1, 3], 3))
+        items, next_id = self.catalog.page(next_id, 2)
+        self.assertEqual((self.ids(items), next_id), ([5, 7], 7))
+        items, next_id = self.catalog.page(next_id, 2)
+        self.assertEqual((self.ids(items), next_id), ([9], None))
+
+    def test_last_full_page(self):
+        # The end is known only when the next page would be empty
+        items, next_id = self.catalog.page(3, 3)
+        self.assertEqual((self.ids(items), next_id), ([5, 7, 9], None))
+        items, next_id = self.catalog.page(1, 3)
+        self.assertEqual((self.ids(items), next_id), ([3, 5, 7], 7))
+
+    def test_after_id_between_ids(self):
+        items, next_id = self.catalog.page(4, 1)
+        self.assertEqual((self.ids(items), next_id), ([5], 5))
+        self.assertEqual(self.catalog.page(9, 5), ([], None))
+
+    def test_no_limit(self):
+        items, next_id = self.catalog.page(3)
+        self.assertEqual((self.ids(items), next_id), ([5, 7, 9], None))
+
+    def test_include(self):
+        owned = {9: 1, 3: 2, 4: 1}  # 4 is not in the catalog
+        items, next_id = self.catalog.page(0, 1, include=owned)
+        self.assertEqual((self.ids(items), next_id), ([3], 3))
+        items, next_id = self.catalog.page(next_id, 1, include=owned)
+        self.assertEqual((self.ids(items), next_id), ([9], None))
+
+    def test_reload(self):
+        payload = self.catalog.payload()
+        self.assertEqual(cf.decode(payload[cf._header.size:])['items'], self.catalog.items())
+        self.catalog.load(ITEMS[:2])
+        self.assertEqual(self.ids(self.catalog.items()), [1, 7])
+        self.assertNotEqual(self.catalog.payload(), payload)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+""" Tests of the ranked skiplist and the leaderboard, run: python -m unittest test_leaderboard """
+
+import random
+import unittest
+from leaderboard import RankedSet, Leaderboard
+
+
+class RankedSetTest(unittest.TestCase):
+    def test_against_sorted_list(self):
+        rnd = random.Random(1)
+        s, expected = RankedSet(), []
+        for _ in range(2000):
+            key = rnd.randrange(500)
+            if key in expected:
+                s.remove(key)
+                expected.remove(key)
+            else:
+                s.add(key)
+                expected.append(key)
+            expected.sort()
+        self.assertEqual(len(s), len(expected))
+        self.assertEqual(s.first(len(expected) + 1), expected)
+        for idx, key in enumerate(expected):
+            self.assertEqual(s.rank(key), idx)
+
+    def test_first(self):
+        s = RankedSet()
+        for key in (5, 1, 3):
+            s.add(key)
+        self.assertEqual(s.first(0), [])
+        self.assertEqual(s.first(2), [1, 3])
+        self.assertEqual(s.first(10), [1, 3, 5])
+
+    def test_missing_key(self):
+        s = RankedSet()
+        s.add((-500, 7))
+        self.assertIsNone(s.rank((-500, 8)))
+        self.assertIsNone(RankedSet().rank(1))
+        with self.assertRaises(KeyError):
+            s.remove((-500, 8))
+        s.remove((-500, 7))
+        self.assertEqual(len(s), 0)
+        self.assertEqual(s.first(1), [])
+
+
+class LeaderboardTest(unittest.TestCase):
+    def setUp(self):
+        self.board = Leaderboard()
+        self.board.load([{'id': 1, 'nickname': 'ann', 'credits': 100},
+                         {'id': 2, 'nickname': 'bob', 'credits': 300},
+                         {'id': 3, 'nickname': 'cid', 'credits': 100}],
+                        {10: 2, 20: 5})
+
+    def test_load(self):
+        self.assertEqual(len(self.board), 3)
+        self.assertEqual(self.board.top_players(2), [{'id': 2, 'nickname': 'bob', 'credits': 300},
+                                                     {'id': 1, 'nickname': 'ann', 'credits': 100}])
+        self.assertEqual(self.board.top_items(5), [(20, 5), (10, 2)])
+
+    def test_set_credits(self):
+        self.board.set_credits(3, 500)
+        self.assertEqual(self.board.rank(3), 1)
+        self.assertEqual(self.board.rank(2), 2)
+        self.assertEqual(self.board.top_players(1), [{'id': 3, 'nickname': 'cid', 'credits': 500}])
+        self.board.set_credits(3, 500)  # Unchanged
+        self.assertEqual(len(self.board), 3)
+
+    def test_ties_by_id(self):
+        self.assertEqual(self.board.rank(1), 2)
+        self.assertEqual(self.board.rank(3), 3)
+
+    def test_new_player(self):
+        self.assertIsNone(self.board.rank(4))
+        self.board.set_credits(4, 200, 'dan')
+        self.assertEqual(self.board.rank(4), 2)
+        self.assertEqual(self.board.top_players(2)[1], {'id': 4, 'nickname': 'dan', 'credits': 200})
+        self.assertEqual(len(self.board), 4)
+
+    def test_add_owned(self):
+        self.board.add_owned(10, 4)
+        self.assertEqual(self.board.top_items(5), [(10, 6), (20, 5)])
+        self.board.add_owned(20, -5)
+        self.assertEqual(self.board.top_items(5), [(10, 6)])
+        self.board.add_owned(30, 6)
+        self.assertEqual(self.board.top_items(5), [(10, 6), (30, 6)])
+
+
+if __name__ == '__main__':
+    unittest.main()